@@ -18,10 +18,10 @@ router = APIRouter()
 chat_manager = ChatHistoryManager(model="llm-agent")
 
 @router.get("/chats")
-async def get_chats(x_session_id: str = Header(None, alias="X-Session-ID"), limit: Optional[int] = None):
-    """Get all chats, optionally limited to a specific number"""
+async def get_chats(x_session_id: str = Header(None, alias="X-Session-ID"), limit: Optional[int] = None, before: Optional[int] = None, before_id: Optional[str] = None):
+    """Get chat summaries, most recent first, optionally limited to a specific number and paged by (dts, chat_id) of the last chat"""
     print("x_session_id:", x_session_id)
-    return chat_manager.get_recent_chats(x_session_id, limit)
+    return chat_manager.get_recent_chats(x_session_id, limit, before, before_id)
 
 @router.get("/chats/{chat_id}")
 async def get_chat(chat_id: str, x_session_id: str = Header(None, alias="X-Session-ID")):
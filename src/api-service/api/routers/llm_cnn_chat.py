@@ -1,17 +1,19 @@
 import os
 from fastapi import APIRouter, Header, Query, Body, HTTPException
 from fastapi.responses import FileResponse
+from fastapi.concurrency import run_in_threadpool
 from typing import Dict, Any, List, Optional
 import uuid
 import time
 from datetime import datetime
 import mimetypes
 import base64
-from tempfile import TemporaryDirectory
 from pathlib import Path
-from api.utils.llm_cnn_utils import chat_sessions, create_chat_session, generate_chat_response, rebuild_chat_session
-from api.utils.llm_cnn_utils import make_prediction
+from api.utils.llm_cnn_utils import chat_sessions, create_chat_session, generate_chat_response, generate_chat_response_stream, rebuild_chat_session
+from api.utils.llm_cnn_utils import predict_image, add_prediction_context
 from api.utils.chat_utils import ChatHistoryManager
+from api.utils.sse_utils import stream_chat_events, sse_response
+from api.utils.image_utils import image_variant_response
 
 # Define Router
 router = APIRouter()
@@ -20,10 +22,10 @@ router = APIRouter()
 chat_manager = ChatHistoryManager(model="llm-cnn")
 
 @router.get("/chats")
-async def get_chats(x_session_id: str = Header(None, alias="X-Session-ID"), limit: Optional[int] = None):
-    """Get all chats, optionally limited to a specific number"""
+async def get_chats(x_session_id: str = Header(None, alias="X-Session-ID"), limit: Optional[int] = None, before: Optional[int] = None, before_id: Optional[str] = None):
+    """Get chat summaries, most recent first, optionally limited to a specific number and paged by (dts, chat_id) of the last chat"""
     print("x_session_id:", x_session_id)
-    return chat_manager.get_recent_chats(x_session_id, limit)
+    return chat_manager.get_recent_chats(x_session_id, limit, before, before_id)
 
 @router.get("/chats/{chat_id}")
 async def get_chat(chat_id: str, x_session_id: str = Header(None, alias="X-Session-ID")):
@@ -35,7 +37,7 @@ async def get_chat(chat_id: str, x_session_id: str = Header(None, alias="X-Sessi
     return chat
 
 @router.post("/chats")
-async def start_chat_with_llm(message: Dict, x_session_id: str = Header(None, alias="X-Session-ID")):
+async def start_chat_with_llm(message: Dict, x_session_id: str = Header(None, alias="X-Session-ID"), stream: bool = False):
     print("content:", message["content"])
     print("x_session_id:", x_session_id)
     """Start a new chat with an initial message"""
@@ -44,12 +46,29 @@ async def start_chat_with_llm(message: Dict, x_session_id: str = Header(None, al
     
     # Create a new chat session
     chat_session = create_chat_session()
-    chat_sessions[chat_id] = chat_session
     
     # Add ID and role to the user message
     message["message_id"] = str(uuid.uuid4())
     message["role"] = "user"
     
+    # Stream text responses as Server-Sent Events (image predictions are returned whole)
+    if stream and not message.get("image"):
+        title = message.get("content")[:50] + "..."
+        chat_response = {
+            "chat_id": chat_id,
+            "title": title,
+            "dts": current_time,
+            "messages": [message]
+        }
+        def on_complete(chat):
+            chat_sessions[chat_id] = chat_session
+            chat_manager.save_chat(chat, x_session_id)
+        return sse_response(stream_chat_events(
+            chat_response,
+            generate_chat_response_stream(chat_session, message),
+            on_complete
+        ))
+    
     # Generate response
     if message.get("image"):
         # Extract the actual base64 data and mime type
@@ -64,23 +83,18 @@ async def start_chat_with_llm(message: Dict, x_session_id: str = Header(None, al
         # Decode base64 to bytes
         image_bytes = base64.b64decode(base64_data)
 
-        # Save the image
-        with TemporaryDirectory() as image_dir:
-            image_path = os.path.join(image_dir, "test.png")
-            with open(image_path, 'wb') as f:
-                f.write(image_bytes)
-
-            # Make prediction
-            prediction_results = make_prediction(image_path)
-            print(prediction_results)
+        # Make prediction straight from the uploaded bytes
+        prediction_results = await predict_image(image_bytes)
+        print(prediction_results)
+        add_prediction_context(chat_session, prediction_results)
 
-            response = {
-                "message_id": str(uuid.uuid4()),
-                "role": "cnn",
-                "results": prediction_results
-            }
+        response = {
+            "message_id": str(uuid.uuid4()),
+            "role": "cnn",
+            "results": prediction_results
+        }
     else:
-        assistant_response = generate_chat_response(chat_session, message)
+        assistant_response = await generate_chat_response(chat_session, message)
         response = {
             "message_id": str(uuid.uuid4()),
             "role": "assistant",
@@ -102,12 +116,15 @@ async def start_chat_with_llm(message: Dict, x_session_id: str = Header(None, al
         ]
     }
     
+    # Cache the session with its new turn
+    await chat_sessions.store(chat_id, chat_session)
+    
     # Save chat
-    chat_manager.save_chat(chat_response, x_session_id)
+    await run_in_threadpool(chat_manager.save_chat, chat_response, x_session_id)
     return chat_response
 
 @router.post("/chats/{chat_id}")
-async def continue_chat_with_llm(chat_id: str, message: Dict, x_session_id: str = Header(None, alias="X-Session-ID")):
+async def continue_chat_with_llm(chat_id: str, message: Dict, x_session_id: str = Header(None, alias="X-Session-ID"), stream: bool = False):
     print("content:", message["content"])
     print("x_session_id:", x_session_id)
     """Add a message to an existing chat"""
@@ -116,10 +133,9 @@ async def continue_chat_with_llm(chat_id: str, message: Dict, x_session_id: str
         raise HTTPException(status_code=404, detail="Chat not found")
     
     # Get or rebuild chat session
-    chat_session = chat_sessions.get(chat_id)
+    chat_session = await chat_sessions.load(chat_id)
     if not chat_session:
         chat_session = rebuild_chat_session(chat["messages"])
-        chat_sessions[chat_id] = chat_session
     
     # Update timestamp
     current_time = int(time.time())
@@ -129,8 +145,20 @@ async def continue_chat_with_llm(chat_id: str, message: Dict, x_session_id: str
     message["message_id"] = str(uuid.uuid4())
     message["role"] = "user"
     
+    # Stream the response as Server-Sent Events
+    if stream:
+        chat["messages"].append(message)
+        def on_complete(chat):
+            chat_sessions[chat_id] = chat_session
+            chat_manager.save_chat(chat, x_session_id)
+        return sse_response(stream_chat_events(
+            chat,
+            generate_chat_response_stream(chat_session, message),
+            on_complete
+        ))
+    
     # Generate response
-    assistant_response = generate_chat_response(chat_session, message)
+    assistant_response = await generate_chat_response(chat_session, message)
     
     # Add messages
     chat["messages"].append(message)
@@ -140,18 +168,29 @@ async def continue_chat_with_llm(chat_id: str, message: Dict, x_session_id: str
         "content": assistant_response
     })
     
+    # Cache the session with its new turn
+    await chat_sessions.store(chat_id, chat_session)
+    
     # Save updated chat
-    chat_manager.save_chat(chat, x_session_id)
+    await run_in_threadpool(chat_manager.save_chat, chat, x_session_id)
     return chat
 
 @router.get("/images/{chat_id}/{message_id}.png")
-async def get_chat_image(chat_id: str, message_id: str):
+async def get_chat_image(
+    chat_id: str,
+    message_id: str,
+    size: Optional[str] = None,
+    fmt: str = Query("webp", alias="format"),
+    if_none_match: Optional[str] = Header(None, alias="If-None-Match")
+):
     """
     Serve an image from the chat history.
     
     Args:
         chat_id: The chat ID
         message_id: The message ID
+        size: Optional resized variant ("thumb" or "medium"), the original if omitted
+        fmt: Format of the resized variant ("webp" or "jpeg")
     
     Returns:
         FileResponse: The image file with appropriate content type
@@ -181,6 +220,10 @@ async def get_chat_image(chat_id: str, message_id: str):
                 detail="Image not found"
             )
         
+        # Serve a resized variant if requested
+        if size:
+            return await image_variant_response(str(image_path), size, fmt, if_none_match)
+        
         # Determine content type
         content_type, _ = mimetypes.guess_type(str(image_path))
         if not content_type:
@@ -1,30 +1,144 @@
+import os
+import sys
+import asyncio
+import importlib
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
+from fastapi.responses import JSONResponse, Response
 from starlette.middleware.cors import CORSMiddleware
-from api.routers import llm_chat, llm_cnn_chat, llm_rag_chat, llm_agent_chat
-from api.routers import newsletter, podcast
+from api.utils.request_context import RequestContextMiddleware
+from api.utils.response_cache import response_cache
+from api.utils.embedding_cache import embedding_cache
+from api.utils.admission_control import admission
+from api.utils.bedrock_utils import hedges
+from api.utils.singleflight import singleflight_stats
+from api.utils.metrics import MetricsMiddleware, registry
 
-# Setup FastAPI app
-app = FastAPI(title="API Server", description="API Server", version="v1")
+# Router families: name -> (router module, prefix). Each is mounted unless ENABLE_<NAME>=0,
+# and its module (with its heavy dependencies) is only imported when it is mounted.
+ROUTERS = {
+    "newsletters": ("api.routers.newsletter", "/newsletters"),
+    "podcasts": ("api.routers.podcast", "/podcasts"),
+    "llm": ("api.routers.llm_chat", "/llm"),
+    "llm_cnn": ("api.routers.llm_cnn_chat", "/llm-cnn"),
+    "llm_rag": ("api.routers.llm_rag_chat", "/llm-rag"),
+    "llm_agent": ("api.routers.llm_agent_chat", "/llm-agent"),
+}
 
-# Enable CORSMiddleware
-app.add_middleware(
-    CORSMiddleware,
-    allow_credentials=False,
-    allow_origins=["*"],
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+
+def router_enabled(name: str) -> bool:
+    return os.environ.get(f"ENABLE_{name.upper()}", "1") == "1"
+
+
+def loaded_module(name: str):
+    """A utils module if an enabled router imported it, else None (never imports it)"""
+    return sys.modules.get(f"api.utils.{name}")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Slow subsystems start in the background so the API serves while they come up
+    tasks = []
+    llm_cnn_utils = loaded_module("llm_cnn_utils")
+    if llm_cnn_utils is not None:
+        tasks.append(asyncio.create_task(llm_cnn_utils.load_cnn_model_in_background()))
+    llm_rag_utils = loaded_module("llm_rag_utils")
+    if llm_rag_utils is not None:
+        tasks.append(asyncio.create_task(llm_rag_utils.connect_chromadb_in_background()))
+    app.state.background_tasks = tasks
+    yield
+    for task in tasks:
+        task.cancel()
 
 
-# Routes
-@app.get("/")
 async def get_index():
     return {"message": "Welcome to AC215"}
 
-# Additional routers here
-app.include_router(newsletter.router, prefix="/newsletters")
-app.include_router(podcast.router, prefix="/podcasts")
-app.include_router(llm_chat.router, prefix="/llm")
-app.include_router(llm_cnn_chat.router, prefix="/llm-cnn")
-app.include_router(llm_rag_chat.router, prefix="/llm-rag")
-app.include_router(llm_agent_chat.router, prefix="/llm-agent")
+
+async def get_ready():
+    """Readiness of the background-loaded subsystems (503 until the CNN model is warm and ChromaDB is connected)"""
+    ready = True
+    content = {}
+    llm_cnn_utils = loaded_module("llm_cnn_utils")
+    if llm_cnn_utils is not None:
+        ready = ready and llm_cnn_utils.cnn_status["state"] == "ready"
+        content["cnn"] = llm_cnn_utils.cnn_status
+    llm_rag_utils = loaded_module("llm_rag_utils")
+    if llm_rag_utils is not None:
+        ready = ready and llm_rag_utils.chromadb_status["state"] == "connected"
+        content["chromadb"] = llm_rag_utils.chromadb_status
+    return JSONResponse(status_code=200 if ready else 503, content={"ready": ready, **content})
+
+
+async def get_stats():
+    """Runtime counters for the in-process caches and the Bedrock admission queue"""
+    stats = {
+        "chat_sessions": [
+            module.chat_sessions.stats()
+            for module in map(loaded_module, ("llm_utils", "llm_rag_utils", "llm_cnn_utils"))
+            if module is not None
+        ],
+        "response_cache": response_cache.stats(),
+        "embedding_cache": embedding_cache.stats(),
+        "bedrock_admission": admission.stats(),
+        "bedrock_hedges": hedges,
+        "singleflight": singleflight_stats(),
+    }
+    llm_rag_utils = loaded_module("llm_rag_utils")
+    if llm_rag_utils is not None:
+        stats["semantic_cache"] = llm_rag_utils.semantic_cache.stats()
+    llm_cnn_utils = loaded_module("llm_cnn_utils")
+    if llm_cnn_utils is not None:
+        stats["cnn_batcher"] = llm_cnn_utils.cnn_batcher.stats()
+        stats["cnn_prediction_cache"] = llm_cnn_utils.prediction_cache.stats()
+    return stats
+
+
+async def get_metrics():
+    """Request, dependency and session metrics in the Prometheus text format"""
+    return Response(content=registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+def create_app() -> FastAPI:
+    """
+    Build the API with the enabled router families.
+
+    Only the enabled routers are imported. TensorFlow is imported while the CNN
+    model loads and ChromaDB is connected with retries, both in the background
+    after startup, so the app accepts connections within about a second and a
+    missing dependency only affects the routes that use it (see /ready).
+    """
+    # Setup FastAPI app
+    app = FastAPI(title="API Server", description="API Server", version="v1", lifespan=lifespan)
+
+    # Enable CORSMiddleware
+    app.add_middleware(
+        CORSMiddleware,
+        allow_credentials=False,
+        allow_origins=["*"],
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+
+    # Expose per-request headers (e.g. cache bypass) to the utils layer
+    app.add_middleware(RequestContextMiddleware)
+
+    # Count and time requests per router family
+    app.add_middleware(MetricsMiddleware, prefixes=[prefix for _, prefix in ROUTERS.values()])
+
+    # Routes
+    app.get("/")(get_index)
+    app.get("/ready")(get_ready)
+    app.get("/stats")(get_stats)
+    app.get("/metrics")(get_metrics)
+
+    # Additional routers here
+    for name, (module_name, prefix) in ROUTERS.items():
+        if router_enabled(name):
+            app.include_router(importlib.import_module(module_name).router, prefix=prefix)
+        else:
+            print(f"Router {name} disabled")
+    return app
+
+
+app = create_app()
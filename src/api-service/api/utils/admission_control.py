@@ -0,0 +1,200 @@
+import os
+import json
+import time
+import asyncio
+from collections import OrderedDict, deque
+from typing import Dict, Any, Optional
+from fastapi import HTTPException
+
+# Admission settings
+BEDROCK_MAX_IN_FLIGHT = int(os.environ.get("BEDROCK_MAX_IN_FLIGHT", os.environ.get("BEDROCK_MAX_WORKERS", "32")))
+BEDROCK_TOKENS_PER_MINUTE = int(os.environ.get("BEDROCK_TOKENS_PER_MINUTE", "0"))  # 0 disables the token limit
+BEDROCK_MAX_QUEUE = int(os.environ.get("BEDROCK_MAX_QUEUE", "256"))  # Waiting calls before new ones get a 429
+BEDROCK_QUEUE_TIMEOUT = float(os.environ.get("BEDROCK_QUEUE_TIMEOUT", "30"))  # Max seconds a call waits for admission
+
+# Wait times kept for the percentile in stats
+WAIT_SAMPLES = 1024
+
+
+def estimate_request_tokens(body: Dict) -> int:
+    """Rough token cost of a Bedrock request: the encoded input plus the output limit"""
+    return len(json.dumps(body, ensure_ascii=False)) // 4 + int(body.get("max_tokens", 0))
+
+
+def response_tokens(response_body: Dict) -> Optional[int]:
+    """Tokens actually used, as reported by the model (Claude usage or Titan embedding counts)"""
+    usage = response_body.get("usage")
+    if usage:
+        return usage.get("input_tokens", 0) + usage.get("output_tokens", 0)
+    if "inputTextTokenCount" in response_body:
+        return response_body["inputTextTokenCount"]
+    return None
+
+
+class AdmissionController:
+    """
+    Gate in front of every Bedrock call.
+
+    At most `max_in_flight` calls run at once and, when `tokens_per_minute` is set,
+    their estimated tokens are drawn from a bucket refilled at that rate. Calls that
+    cannot start wait in per-session FIFO queues served round-robin, so one busy
+    session cannot starve the others. When `max_queue` calls are already waiting,
+    or a call waits longer than `queue_timeout`, it fails fast with a 429 instead of
+    piling onto a throttled backend.
+
+    Runs on the event loop only; release() may be scheduled from other threads with
+    loop.call_soon_threadsafe.
+    """
+
+    def __init__(self, max_in_flight: int = BEDROCK_MAX_IN_FLIGHT, tokens_per_minute: int = BEDROCK_TOKENS_PER_MINUTE,
+                 max_queue: int = BEDROCK_MAX_QUEUE, queue_timeout: float = BEDROCK_QUEUE_TIMEOUT):
+        self.max_in_flight = max_in_flight
+        self.tokens_per_minute = tokens_per_minute
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self._queues: "OrderedDict[str, deque]" = OrderedDict()  # session id -> waiting (future, cost, queued at)
+        self._depth = 0
+        self._tokens = float(tokens_per_minute)
+        self._refilled = time.monotonic()
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._waits: deque = deque(maxlen=WAIT_SAMPLES)
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    def _cost(self, cost: int) -> int:
+        # A single call larger than the whole bucket would otherwise never start
+        return min(cost, self.tokens_per_minute) if self.tokens_per_minute else 0
+
+    def _refill(self) -> None:
+        if not self.tokens_per_minute:
+            return
+        now = time.monotonic()
+        self._tokens = min(self.tokens_per_minute, self._tokens + (now - self._refilled) * self.tokens_per_minute / 60)
+        self._refilled = now
+
+    def _admit(self, cost: int, waited: float) -> None:
+        self.in_flight += 1
+        self._tokens -= cost
+        self.admitted += 1
+        self._waits.append(waited)
+
+    def _dispatch(self) -> None:
+        """Start waiting calls, round-robin across sessions, while there is capacity"""
+        self._timer = None
+        self._refill()
+        while self._queues and self.in_flight < self.max_in_flight:
+            session, waiters = next(iter(self._queues.items()))
+            future, cost, queued = waiters[0]
+            if self.tokens_per_minute and self._tokens < cost:
+                delay = (cost - self._tokens) * 60 / self.tokens_per_minute
+                self._timer = asyncio.get_running_loop().call_later(delay, self._dispatch)
+                return
+            waiters.popleft()
+            self._depth -= 1
+            self._admit(cost, time.monotonic() - queued)
+            future.set_result(None)
+            if waiters:
+                self._queues.move_to_end(session)
+            else:
+                del self._queues[session]
+
+    def _remove(self, session: str, entry: tuple) -> None:
+        waiters = self._queues.get(session)
+        if waiters is not None and entry in waiters:
+            waiters.remove(entry)
+            self._depth -= 1
+            if not waiters:
+                del self._queues[session]
+
+    async def acquire(self, cost: int, session: str = "") -> int:
+        """
+        Wait for permission to start a Bedrock call.
+
+        Args:
+            cost: Estimated tokens of the call
+            session: Session the call belongs to, for fair queueing
+
+        Returns:
+            int: The tokens charged, to be passed back to release()
+        """
+        cost = self._cost(cost)
+        self._refill()
+        if not self._queues and self.in_flight < self.max_in_flight and self._tokens >= cost:
+            self._admit(cost, 0.0)
+            return cost
+
+        if self._depth >= self.max_queue:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=429,
+                detail="Too many model requests in progress, please retry shortly",
+                headers={"Retry-After": "1"}
+            )
+
+        future = asyncio.get_running_loop().create_future()
+        entry = (future, cost, time.monotonic())
+        self._queues.setdefault(session, deque()).append(entry)
+        self._depth += 1
+        if self._timer is None:
+            self._dispatch()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            if future.done():
+                self.release(cost)
+            else:
+                self._remove(session, entry)
+            self.timed_out += 1
+            raise HTTPException(
+                status_code=429,
+                detail=f"Model request waited more than {self.queue_timeout} seconds to start, please retry shortly",
+                headers={"Retry-After": "1"}
+            )
+        except asyncio.CancelledError:
+            # The caller went away; give the slot back if it was granted meanwhile
+            if future.done():
+                self.release(cost)
+            else:
+                self._remove(session, entry)
+            raise
+        return cost
+
+    def has_capacity(self) -> bool:
+        """Whether a call could start right now without waiting"""
+        self._refill()
+        return not self._queues and self.in_flight < self.max_in_flight
+
+    def release(self, cost: int, used_tokens: Optional[int] = None) -> None:
+        """
+        Finish a call started with acquire() and wake the next waiting one.
+
+        Args:
+            cost: The tokens charged by acquire()
+            used_tokens: Tokens the call actually used, to correct the estimate
+        """
+        self.in_flight -= 1
+        if self.tokens_per_minute and used_tokens is not None:
+            self._tokens = min(self.tokens_per_minute, self._tokens + cost - used_tokens)
+        if self._queues and self._timer is None:
+            self._dispatch()
+
+    def stats(self) -> Dict[str, Any]:
+        waits = sorted(self._waits)
+        return {
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "queue_depth": self._depth,
+            "sessions_waiting": len(self._queues),
+            "tokens_available": round(self._tokens) if self.tokens_per_minute else None,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "wait_ms_avg": round(1000 * sum(waits) / len(waits), 2) if waits else 0.0,
+            "wait_ms_p95": round(1000 * waits[int(0.95 * (len(waits) - 1))], 2) if waits else 0.0,
+            "wait_ms_max": round(1000 * waits[-1], 2) if waits else 0.0,
+        }
+
+
+admission = AdmissionController()
@@ -0,0 +1,122 @@
+import asyncio
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Callable, List, Optional, Tuple
+
+
+class MicroBatcher:
+    """
+    Groups concurrent single-item inference requests into batches.
+
+    Requests are queued; a background task takes the first waiting request, then
+    keeps collecting until `max_batch_size` requests or `max_wait_ms` have passed,
+    runs one forward pass over the stacked inputs and hands each request its row of
+    the output. Passes run one at a time on a dedicated thread, and requests that
+    arrive during a pass form the next batch, so batches grow with load while a
+    lone request waits at most `max_wait_ms` extra.
+
+    Batches are padded up to a power of two, so the model only ever sees a few
+    distinct input shapes and is not retraced for every batch size. With `dtype`,
+    inputs are copied into one preallocated batch array of that type, reused for
+    every pass, instead of allocating a new batch each time.
+    """
+
+    def __init__(self, predict_batch: Callable[[np.ndarray], np.ndarray], max_batch_size: int = 16,
+                 max_wait_ms: float = 5, name: str = "batcher", dtype: Optional[np.dtype] = None):
+        self.predict_batch = predict_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.name = name
+        self.dtype = dtype
+        self._buffer: Optional[np.ndarray] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+        self.batches = 0
+        self.items = 0
+
+    def _start(self) -> None:
+        # Created on first use, so the queue and task belong to the serving event loop
+        if self._task is None or self._task.done():
+            self._queue = asyncio.Queue()
+            self._task = asyncio.ensure_future(self._run())
+
+    async def submit(self, item: np.ndarray) -> np.ndarray:
+        """
+        Run inference on one input as part of a batch.
+
+        Args:
+            item: A single preprocessed input, without the batch dimension
+
+        Returns:
+            np.ndarray: The model output for this input, without the batch dimension
+        """
+        self._start()
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((item, future))
+        return await future
+
+    async def _collect(self) -> List[Tuple[np.ndarray, asyncio.Future]]:
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout=remaining))
+            except asyncio.TimeoutError:
+                break
+        # Requests whose callers went away are not worth computing
+        return [(item, future) for item, future in batch if not future.done()]
+
+    def _padded_predict(self, items: List[np.ndarray]) -> np.ndarray:
+        """Run one pass over the items, padded to a power of two (runs on the batcher thread)"""
+        size = len(items)
+        padded_size = min(1 << (size - 1).bit_length(), self.max_batch_size)
+        if self.dtype is None:
+            inputs = np.stack(items)
+            if padded_size > size:
+                padding = np.zeros((padded_size - size,) + inputs.shape[1:], dtype=inputs.dtype)
+                inputs = np.concatenate([inputs, padding])
+        else:
+            # Passes are serialized on one thread, so the buffer is never shared
+            if self._buffer is None or self._buffer.shape[1:] != items[0].shape:
+                self._buffer = np.empty((self.max_batch_size,) + items[0].shape, dtype=self.dtype)
+            inputs = self._buffer[:padded_size]
+            for row, item in zip(inputs, items):
+                row[...] = item
+            inputs[size:] = 0
+        return np.asarray(self.predict_batch(inputs))[:size]
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            if not batch:
+                continue
+            try:
+                outputs = await loop.run_in_executor(self._executor, self._padded_predict, [item for item, _ in batch])
+            except Exception as e:
+                print(f"Error running {self.name} batch: {str(e)}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.batches += 1
+            self.items += len(batch)
+            for (_, future), output in zip(batch, outputs):
+                if not future.done():
+                    future.set_result(output)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "avg_batch_size": round(self.items / self.batches, 2) if self.batches else 0.0,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+        }
@@ -0,0 +1,372 @@
+import os
+import json
+import time
+import random
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, AsyncIterator, Optional
+from fastapi import HTTPException
+import boto3
+import botocore
+from botocore.config import Config
+from api.utils.admission_control import admission, estimate_request_tokens, response_tokens
+from api.utils.request_context import session_id
+from api.utils.metrics import track_dependency
+
+# Setup
+AWS_REGION = os.environ.get("AWS_DEFAULT_REGION", "us-east-1").strip()
+AWS_ACCESS_KEY_ID = os.environ.get("AWS_ACCESS_KEY_ID").strip()
+AWS_SECRET_ACCESS_KEY = os.environ.get("AWS_SECRET_ACCESS_KEY").strip()
+
+# Gateway settings
+BEDROCK_MAX_WORKERS = int(os.environ.get("BEDROCK_MAX_WORKERS", "32"))  # Max concurrent Bedrock calls per worker
+BEDROCK_TIMEOUT = float(os.environ.get("BEDROCK_TIMEOUT", "120"))  # Per-call deadline in seconds, retries included
+BEDROCK_MAX_ATTEMPTS = int(os.environ.get("BEDROCK_MAX_ATTEMPTS", "4"))  # Attempts per call for retryable errors
+BEDROCK_BACKOFF_BASE = float(os.environ.get("BEDROCK_BACKOFF_BASE", "0.25"))  # First backoff ceiling in seconds
+BEDROCK_BACKOFF_CAP = float(os.environ.get("BEDROCK_BACKOFF_CAP", "8"))  # Largest backoff in seconds
+BEDROCK_HEDGE_PERCENTILE = float(os.environ.get("BEDROCK_HEDGE_PERCENTILE", "0.95"))  # Hedge calls slower than this
+BEDROCK_HEDGE_MIN_SAMPLES = 20  # Latencies needed before hedging starts
+
+# Bedrock error codes worth retrying, and the status reported once retries run out
+RETRYABLE_ERROR_CODES = {
+    "ThrottlingException",
+    "TooManyRequestsException",
+    "ServiceUnavailableException",
+    "ModelNotReadyException",
+    "InternalServerException",
+    "ModelTimeoutException",
+}
+ERROR_STATUS_CODES = {
+    "ThrottlingException": 429,
+    "TooManyRequestsException": 429,
+    "ServiceUnavailableException": 503,
+    "ModelNotReadyException": 503,
+    "ModelTimeoutException": 504,
+}
+
+# Dependency names in the metrics, by model ID prefix
+MODEL_DEPENDENCIES = {
+    "amazon.titan-embed": "titan_embedding",
+    "anthropic.claude": "claude",
+}
+
+# Boto3 clients are thread safe, so a single client is shared by every executor thread.
+# The connection pool is sized to the executor so threads never wait on a socket.
+# Retries are handled below (with backoff, deadlines and admission), so boto3 makes a single attempt.
+bedrock = boto3.client(
+    service_name='bedrock-runtime',
+    region_name=AWS_REGION,
+    aws_access_key_id=AWS_ACCESS_KEY_ID,
+    aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+    config=Config(
+        max_pool_connections=BEDROCK_MAX_WORKERS,
+        connect_timeout=10,
+        read_timeout=BEDROCK_TIMEOUT,
+        retries={"total_max_attempts": 1, "mode": "standard"},
+    )
+)
+
+# Bounded executor that runs the blocking boto3 calls off the event loop
+executor = ThreadPoolExecutor(max_workers=BEDROCK_MAX_WORKERS, thread_name_prefix="bedrock")
+
+
+class LatencyTracker:
+    """Recent successful call latencies per model, for choosing when to hedge"""
+
+    def __init__(self, samples: int = 512):
+        self.samples = samples
+        self._latencies: Dict[str, deque] = {}
+        self._percentiles: Dict[str, float] = {}
+
+    def record(self, model_id: str, seconds: float) -> None:
+        latencies = self._latencies.setdefault(model_id, deque(maxlen=self.samples))
+        latencies.append(seconds)
+        # Recompute the percentile every few samples rather than on every call
+        if len(latencies) >= BEDROCK_HEDGE_MIN_SAMPLES and len(latencies) % 16 == 0:
+            ordered = sorted(latencies)
+            self._percentiles[model_id] = ordered[int(BEDROCK_HEDGE_PERCENTILE * (len(ordered) - 1))]
+
+    def hedge_delay(self, model_id: str) -> Optional[float]:
+        """Seconds to wait before sending a duplicate call, or None until enough samples exist"""
+        return self._percentiles.get(model_id)
+
+
+latencies = LatencyTracker()
+hedges = {"sent": 0, "won": 0}
+
+
+def _dependency(model_id: str) -> str:
+    return next((name for prefix, name in MODEL_DEPENDENCIES.items() if model_id.startswith(prefix)), model_id)
+
+
+def _invoke_model(model_id: str, body: Dict) -> Dict:
+    """Call Bedrock and parse the JSON response body (runs in the executor)"""
+    response = bedrock.invoke_model(
+        modelId=model_id,
+        contentType="application/json",
+        accept="application/json",
+        body=json.dumps(body)
+    )
+    return json.loads(response['body'].read())
+
+
+def _error_code(error: Exception) -> str:
+    if isinstance(error, botocore.exceptions.ClientError):
+        return error.response['Error']['Code']
+    return type(error).__name__
+
+
+def _is_retryable(error: Exception) -> bool:
+    """Throttling, transient service errors and connection failures are retried; everything else fails at once"""
+    if isinstance(error, botocore.exceptions.ClientError):
+        return _error_code(error) in RETRYABLE_ERROR_CODES
+    return isinstance(error, (botocore.exceptions.ConnectionError, botocore.exceptions.HTTPClientError))
+
+
+def _backoff(attempt: int, remaining: float) -> Optional[float]:
+    """
+    Full-jitter exponential backoff before retry number `attempt`.
+
+    Returns:
+        Optional[float]: Seconds to sleep, or None if there is no attempt or time left for a retry
+    """
+    if attempt + 1 >= BEDROCK_MAX_ATTEMPTS:
+        return None
+    delay = random.uniform(0, min(BEDROCK_BACKOFF_CAP, BEDROCK_BACKOFF_BASE * 2 ** attempt))
+    # Leave the retry itself some time before the deadline
+    if delay + BEDROCK_BACKOFF_BASE >= remaining:
+        return None
+    return delay
+
+
+def _http_error(model_id: str, error: Exception, timeout: float) -> Optional[HTTPException]:
+    """Map a failed Bedrock call to the HTTP error reported to the client (None for unexpected errors)"""
+    if isinstance(error, HTTPException):
+        return error
+    if isinstance(error, asyncio.TimeoutError):
+        print(f"Bedrock call to {model_id} timed out after {timeout}s")
+        return HTTPException(
+            status_code=504,
+            detail=f"Model {model_id} did not respond within {timeout} seconds"
+        )
+    if isinstance(error, botocore.exceptions.ClientError):
+        error_code = error.response['Error']['Code']
+        error_message = error.response['Error']['Message']
+        print(f"AWS Error: {error_code} - {error_message}")
+        status_code = ERROR_STATUS_CODES.get(error_code, 500)
+        return HTTPException(
+            status_code=status_code,
+            detail=f"AWS Error: {error_code} - {error_message}",
+            headers={"Retry-After": "1"} if status_code in (429, 503) else None
+        )
+    if _is_retryable(error):
+        print(f"Bedrock connection error: {str(error)}")
+        return HTTPException(
+            status_code=503,
+            detail=f"Model {model_id} is unreachable: {str(error)}",
+            headers={"Retry-After": "1"}
+        )
+    return None
+
+
+async def _attempt(model_id: str, body: Dict, timeout: float) -> Dict:
+    """One admitted Bedrock call; the slot is held until the call finishes, even if the caller stops waiting"""
+    cost = await admission.acquire(estimate_request_tokens(body), session_id.get())
+    loop = asyncio.get_running_loop()
+    started = time.monotonic()
+    future = loop.run_in_executor(executor, _invoke_model, model_id, body)
+    future.add_done_callback(
+        lambda f: admission.release(cost, None if f.cancelled() or f.exception() else response_tokens(f.result()))
+    )
+    response_body = await asyncio.wait_for(asyncio.shield(future), timeout=timeout)
+    latencies.record(model_id, time.monotonic() - started)
+    return response_body
+
+
+async def _hedged_attempt(model_id: str, body: Dict, timeout: float) -> Dict:
+    """
+    A call that sends a duplicate if the first has not answered within the usual
+    latency percentile, and returns whichever answers first.
+    """
+    primary = asyncio.ensure_future(_attempt(model_id, body, timeout))
+    tasks = {primary}
+    try:
+        delay = latencies.hedge_delay(model_id)
+        if delay is not None and delay < timeout:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            # Hedge only with spare capacity, so duplicates never queue behind real work
+            if not done and admission.has_capacity():
+                hedges["sent"] += 1
+                tasks.add(asyncio.ensure_future(_attempt(model_id, body, timeout - delay)))
+        error = None
+        while tasks:
+            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is not primary:
+                        hedges["won"] += 1
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def invoke_model(model_id: str, body: Dict, timeout: float = BEDROCK_TIMEOUT, hedge: bool = False) -> Dict:
+    """
+    Invoke a Bedrock model without blocking the event loop.
+
+    Each attempt first waits for the admission controller. Throttling and transient
+    errors are retried with jittered exponential backoff while the deadline allows;
+    once retries run out, throttling is reported as 429 and unavailability as 503.
+
+    Args:
+        model_id: The Bedrock model ID
+        body: The request body (will be JSON encoded)
+        timeout: Seconds until the deadline for the call, retries included
+        hedge: Send a duplicate call if the first is slower than usual (for idempotent calls like embeddings)
+
+    Returns:
+        Dict: The parsed response body
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    attempt = 0
+    with track_dependency(_dependency(model_id), "invoke_model"):
+        while True:
+            try:
+                if hedge:
+                    return await _hedged_attempt(model_id, body, deadline - loop.time())
+                return await _attempt(model_id, body, deadline - loop.time())
+            except Exception as e:
+                delay = _backoff(attempt, deadline - loop.time()) if _is_retryable(e) else None
+                if delay is None:
+                    http_error = _http_error(model_id, e, timeout)
+                    if http_error is None:
+                        raise
+                    raise http_error
+                print(f"Retrying Bedrock call to {model_id} in {delay:.2f}s after {_error_code(e)}")
+                await asyncio.sleep(delay)
+                attempt += 1
+
+
+class StreamHandle:
+    """
+    Lets the consumer of a streamed response stop the thread producing it.
+
+    Once the consumer goes away (client disconnect, error), the producer stops
+    reading at the next event and the response body is closed, which also unblocks
+    a read that is waiting on the network.
+    """
+
+    def __init__(self):
+        self.stopped = threading.Event()
+        self.stream = None
+
+    def stop(self) -> None:
+        self.stopped.set()
+        stream = self.stream
+        if stream is not None:
+            try:
+                stream.close()
+            except Exception:
+                pass
+
+
+def _stream_model(model_id: str, body: Dict, loop: asyncio.AbstractEventLoop, queue: asyncio.Queue, cost: int,
+                  handle: StreamHandle) -> None:
+    """Call Bedrock with a streaming response and push text deltas onto the queue (runs in the executor)"""
+    used_tokens = None
+    try:
+        response = bedrock.invoke_model_with_response_stream(
+            modelId=model_id,
+            contentType="application/json",
+            accept="application/json",
+            body=json.dumps(body)
+        )
+        handle.stream = response['body']
+        for event in response['body']:
+            if handle.stopped.is_set():
+                break
+            chunk = json.loads(event['chunk']['bytes'])
+            if chunk.get('type') == 'message_start':
+                used_tokens = chunk['message']['usage']['input_tokens']
+            elif chunk.get('type') == 'message_delta' and used_tokens is not None:
+                used_tokens += chunk.get('usage', {}).get('output_tokens', 0)
+            if chunk.get('type') == 'content_block_delta' and chunk['delta'].get('type') == 'text_delta':
+                loop.call_soon_threadsafe(queue.put_nowait, chunk['delta']['text'])
+        loop.call_soon_threadsafe(queue.put_nowait, None)
+    except Exception as e:
+        if not handle.stopped.is_set():
+            loop.call_soon_threadsafe(queue.put_nowait, e)
+    finally:
+        if handle.stream is not None:
+            handle.stream.close()
+        loop.call_soon_threadsafe(admission.release, cost, used_tokens)
+
+
+async def _next_item(model_id: str, queue: asyncio.Queue, timeout: float) -> Any:
+    try:
+        return await asyncio.wait_for(queue.get(), timeout=timeout)
+    except asyncio.TimeoutError:
+        print(f"Bedrock stream from {model_id} stalled for {timeout}s")
+        raise HTTPException(
+            status_code=504,
+            detail=f"Model {model_id} did not respond within {timeout} seconds"
+        )
+
+
+async def invoke_model_stream(model_id: str, body: Dict, timeout: float = BEDROCK_TIMEOUT) -> AsyncIterator[str]:
+    """
+    Invoke a Bedrock model and yield the generated text as it arrives.
+
+    Failures before the first text arrives are retried like invoke_model; once text
+    has been yielded the stream cannot be replayed, so later failures are raised.
+
+    Args:
+        model_id: The Bedrock model ID
+        body: The request body (will be JSON encoded)
+        timeout: Seconds to wait for each chunk of the response
+
+    Yields:
+        str: Text deltas in generation order
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    attempt = 0
+    handle = None
+    with track_dependency(_dependency(model_id), "invoke_model_stream"):
+        try:
+            while True:
+                cost = await admission.acquire(estimate_request_tokens(body), session_id.get())
+                queue: asyncio.Queue = asyncio.Queue()
+                handle = StreamHandle()
+                loop.run_in_executor(executor, _stream_model, model_id, body, loop, queue, cost, handle)
+                item = await _next_item(model_id, queue, timeout)
+                if not isinstance(item, Exception):
+                    break
+                delay = _backoff(attempt, deadline - loop.time()) if _is_retryable(item) else None
+                if delay is None:
+                    break
+                print(f"Retrying Bedrock stream from {model_id} in {delay:.2f}s after {_error_code(item)}")
+                await asyncio.sleep(delay)
+                attempt += 1
+
+            while item is not None:
+                if isinstance(item, Exception):
+                    http_error = _http_error(model_id, item, timeout)
+                    if http_error is None:
+                        http_error = HTTPException(
+                            status_code=500,
+                            detail=f"Failed to stream response: {str(item)}"
+                        )
+                    raise http_error
+                yield item
+                item = await _next_item(model_id, queue, timeout)
+        finally:
+            # The consumer is done with the stream (or went away): stop reading it
+            if handle is not None:
+                handle.stop()
@@ -0,0 +1,88 @@
+import os
+import json
+import time
+import threading
+import traceback
+from typing import Dict, List, Optional, Tuple
+
+# Seconds between checks of the folder for added, changed or removed files
+CATALOG_REFRESH_INTERVAL = float(os.environ.get("CATALOG_REFRESH_INTERVAL", "2"))
+
+
+class Catalog:
+    """
+    In-memory catalog of the JSON items (newsletters, podcasts) in a data folder.
+
+    Items are keyed by file name without extension and kept pre-sorted by dts,
+    newest first. The folder is re-checked at most every `refresh_interval` seconds,
+    and only files whose mtime or size changed are parsed again, so listings are
+    served from memory however many items the ML task drops into the folder.
+    """
+
+    def __init__(self, data_folder: str, refresh_interval: float = CATALOG_REFRESH_INTERVAL):
+        self.data_folder = data_folder
+        self.refresh_interval = refresh_interval
+        self._files: Dict[str, Tuple[int, int]] = {}  # item id -> (mtime_ns, size)
+        self._items: Dict[str, Dict] = {}
+        self._sorted: List[Dict] = []
+        self._last_check = 0.0
+        self._lock = threading.Lock()
+
+    def _load_item(self, filepath: str) -> Optional[Dict]:
+        try:
+            with open(filepath, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e:
+            print(f"Error loading {filepath}: {str(e)}")
+            traceback.print_exc()
+            return None
+
+    def refresh(self, force: bool = False) -> None:
+        """Pick up added, changed and removed files"""
+        now = time.monotonic()
+        if not force and now - self._last_check < self.refresh_interval:
+            return
+        with self._lock:
+            self._last_check = now
+            try:
+                entries = [entry for entry in os.scandir(self.data_folder) if entry.name.endswith(".json") and entry.is_file()]
+            except FileNotFoundError:
+                entries = []
+
+            changed = False
+            seen = set()
+            for entry in entries:
+                item_id = entry.name[:-len(".json")]
+                seen.add(item_id)
+                stat = entry.stat()
+                signature = (stat.st_mtime_ns, stat.st_size)
+                if self._files.get(item_id) == signature:
+                    continue
+                item = self._load_item(entry.path)
+                self._files[item_id] = signature
+                if item is None:
+                    self._items.pop(item_id, None)
+                else:
+                    self._items[item_id] = item
+                changed = True
+
+            for item_id in set(self._files) - seen:
+                del self._files[item_id]
+                self._items.pop(item_id, None)
+                changed = True
+
+            if changed:
+                # Sort by dts
+                self._sorted = sorted(self._items.values(), key=lambda x: x.get('dts', 0), reverse=True)
+
+    def list(self, limit: Optional[int] = None) -> List[Dict]:
+        """All items, newest first, optionally limited to a specific number"""
+        self.refresh()
+        if limit:
+            return self._sorted[:limit]
+        return self._sorted
+
+    def get(self, item_id: str) -> Optional[Dict]:
+        """Get a specific item by ID"""
+        self.refresh()
+        return self._items.get(item_id)
@@ -7,13 +7,194 @@ import glob
 import base64
 import traceback
 import io
+import re
+import bisect
+import fcntl
+import threading
+import hashlib
+import tempfile
+from collections import OrderedDict
+from contextlib import contextmanager
+from api.utils.metrics import track_dependency
+
+# Directory of the chat logs and images of every chat family
+CHAT_HISTORY_DIR = os.environ.get("CHAT_HISTORY_DIR", "chat-history")
+# Rewrite a chat log once it holds this many header updates
+CHAT_LOG_COMPACT_EVERY = int(os.environ.get("CHAT_LOG_COMPACT_EVERY", "64"))
+# Flush every saved turn to disk; with 0 a crash of the host may lose the last few seconds of chats
+CHAT_LOG_FSYNC = os.environ.get("CHAT_LOG_FSYNC", "1") == "1"
+# Number of chats whose persisted state is remembered between saves
+CHAT_LOG_TRACKED_CHATS = 4096
+# Number of session indexes kept in memory
+CHAT_INDEX_CACHED_SESSIONS = 1024
+# Base64 characters decoded per step when storing an image (multiple of 4)
+IMAGE_DECODE_CHUNK = 64 * 1024
+
+# File extensions for image formats, recognized by their leading bytes
+IMAGE_SIGNATURES = [
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"\xff\xd8\xff", "jpg"),
+    (b"GIF87a", "gif"),
+    (b"GIF89a", "gif"),
+]
+IMAGE_MIME_EXTENSIONS = {
+    "image/png": "png",
+    "image/jpeg": "jpg",
+    "image/jpg": "jpg",
+    "image/gif": "gif",
+    "image/webp": "webp",
+}
+
+
+class ChatIndex:
+    """
+    Summary index (chat_id, title, dts) of the chats in one session directory.
+
+    Backed by an append-only index.jsonl where the latest line for a chat wins,
+    and held in memory sorted by dts so a page of chats costs O(log n + limit).
+    Lines appended by other workers are picked up by reading only the new tail
+    of the file. An index replaced by another worker's compaction (a new inode,
+    or a file shorter than what was read) is reloaded from the start.
+
+    Appends hold a shared lock on index.lock and compaction an exclusive one, so
+    no line is appended to a file that is being replaced.
+    """
+    FILENAME = "index.jsonl"
+    LOCK_FILENAME = "index.lock"
+
+    def __init__(self, chat_dir: str):
+        self.filepath = os.path.join(chat_dir, self.FILENAME)
+        self.lockpath = os.path.join(chat_dir, self.LOCK_FILENAME)
+        self.summaries: Dict[str, Dict] = {}
+        self._keys: List[tuple] = []  # (-dts, chat_id), ascending = most recent first
+        self._offset = 0
+        self._lines = 0
+        self._inode = None  # Inode of the file read so far
+        self._lock = threading.RLock()  # Saves run in the threadpool
+
+    @staticmethod
+    def _key(summary: Dict) -> tuple:
+        return (-summary.get("dts", 0), summary["chat_id"])
+
+    def _apply(self, summary: Dict) -> None:
+        previous = self.summaries.get(summary["chat_id"])
+        if previous is not None:
+            key = self._key(previous)
+            del self._keys[bisect.bisect_left(self._keys, key)]
+        self.summaries[summary["chat_id"]] = summary
+        bisect.insort(self._keys, self._key(summary))
+
+    @contextmanager
+    def _locked(self, operation: int):
+        """Hold a lock on the index shared by every worker (fcntl.LOCK_SH or LOCK_EX)"""
+        fd = os.open(self.lockpath, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, operation)
+            yield
+        finally:
+            os.close(fd)  # Releases the lock
+
+    def refresh(self) -> None:
+        """Read index lines appended since the last refresh"""
+        with self._lock:
+            try:
+                f = open(self.filepath, 'rb')
+            except FileNotFoundError:
+                return
+            with f:
+                # Stat the open file, so a replacement after this point waits for the next refresh
+                stat = os.fstat(f.fileno())
+                if stat.st_ino != self._inode or stat.st_size < self._offset:
+                    # The index was compacted by another worker, reload it
+                    self.summaries, self._keys, self._offset, self._lines = {}, [], 0, 0
+                    self._inode = stat.st_ino
+                if stat.st_size == self._offset:
+                    return
+                f.seek(self._offset)
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break
+                    self._offset += len(line)
+                    try:
+                        self._apply(json.loads(line))
+                        self._lines += 1
+                    except (json.JSONDecodeError, KeyError):
+                        continue
+
+    def update(self, summary: Dict) -> None:
+        """Record the latest summary of a chat"""
+        with self._lock:
+            line = (json.dumps(summary, ensure_ascii=False) + "\n").encode("utf-8")
+            with self._locked(fcntl.LOCK_SH):
+                with open(self.filepath, 'ab') as f:
+                    f.write(line)
+            # Reads the line back, along with any appended by other workers
+            self.refresh()
+            if self._lines > 2 * len(self.summaries) + 64:
+                self.compact()
+
+    def compact(self) -> None:
+        """Rewrite the index with one line per chat"""
+        with self._lock, self._locked(fcntl.LOCK_EX):
+            # Include the lines other workers appended since the last refresh
+            self.refresh()
+            data = b"".join(
+                (json.dumps(self.summaries[chat_id], ensure_ascii=False) + "\n").encode("utf-8")
+                for _, chat_id in self._keys
+            )
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.filepath), prefix="index.", suffix=".tmp")
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                    inode = os.fstat(f.fileno()).st_ino
+                os.replace(tmp_path, self.filepath)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+            self._inode = inode
+            self._offset = len(data)
+            self._lines = len(self.summaries)
+
+    def page(self, limit: Optional[int] = None, before: Optional[int] = None, before_id: Optional[str] = None) -> List[Dict]:
+        """
+        Most recent chats first, optionally only those after the cursor.
+
+        The cursor is the (dts, chat_id) of the last chat of the previous page, so
+        chats sharing that dts are not skipped. With `before` alone, only chats with
+        an older dts are returned.
+        """
+        with self._lock:
+            self.refresh()
+            start = 0
+            if before is not None and before_id is not None:
+                start = bisect.bisect_right(self._keys, (-before, before_id))
+            elif before is not None:
+                start = bisect.bisect_left(self._keys, (-before + 1, ""))
+            end = len(self._keys) if not limit else min(len(self._keys), start + limit)
+            return [self.summaries[chat_id] for _, chat_id in self._keys[start:end]]
         
 class ChatHistoryManager:
-    def __init__(self, model, history_dir: str = "chat-history"):
+    """
+    Persists chats as append-only logs, one JSONL file per chat.
+
+    The first line is a header with the chat fields (chat_id, title, dts, ...),
+    followed by one line per message. Later changes to the chat fields are
+    appended as "meta" lines. Saving a turn therefore appends only the new
+    messages. The log is rewritten (compacted) once it has accumulated
+    CHAT_LOG_COMPACT_EVERY meta lines. Chats saved as a single JSON file by
+    earlier versions are still read, and are converted on their next save.
+    """
+    def __init__(self, model, history_dir: str = CHAT_HISTORY_DIR):
         """Initialize the chat history manager with the specified directory"""
         self.model = model
         self.history_dir = os.path.join(history_dir, model)
         self.images_dir = os.path.join(self.history_dir, "images")
+        # (session_id, chat_id) -> (messages persisted, meta lines in the log)
+        self._log_state: OrderedDict = OrderedDict()
+        # session_id -> ChatIndex
+        self._indexes: OrderedDict = OrderedDict()
+        # Guards both, since chats are saved from the threadpool
+        self._lock = threading.RLock()
         self._ensure_directories()
     
     def _ensure_directories(self) -> None:
@@ -22,12 +203,205 @@ class ChatHistoryManager:
         os.makedirs(self.images_dir, exist_ok=True)
     
     def _get_chat_filepath(self, chat_id: str, session_id: str) -> str:
-        """Get the full file path for a chat JSON file"""
+        """Get the full file path for a chat log file"""
+        return os.path.join(self.history_dir, session_id, f"{chat_id}.jsonl")
+
+    def _get_legacy_chat_filepath(self, chat_id: str, session_id: str) -> str:
+        """Get the full file path for a chat saved as a single JSON file"""
         return os.path.join(self.history_dir, session_id, f"{chat_id}.json")
+
+    def _remember_log_state(self, chat_id: str, session_id: str, message_count: int, meta_count: int) -> None:
+        with self._lock:
+            key = (session_id, chat_id)
+            self._log_state[key] = (message_count, meta_count)
+            self._log_state.move_to_end(key)
+            while len(self._log_state) > CHAT_LOG_TRACKED_CHATS:
+                self._log_state.popitem(last=False)
+
+    def _get_index(self, session_id: str) -> ChatIndex:
+        """Get the chat index of a session, building it from the chat files the first time"""
+        with self._lock:
+            index = self._indexes.get(session_id)
+            if index is None:
+                chat_dir = os.path.join(self.history_dir, session_id)
+                os.makedirs(chat_dir, exist_ok=True)
+                index = ChatIndex(chat_dir)
+                if not os.path.exists(index.filepath):
+                    self._build_index(session_id, index)
+                self._indexes[session_id] = index
+            self._indexes.move_to_end(session_id)
+            while len(self._indexes) > CHAT_INDEX_CACHED_SESSIONS:
+                self._indexes.popitem(last=False)
+            return index
+
+    def _build_index(self, session_id: str, index: ChatIndex) -> None:
+        """Index the chats saved before the session had an index (one-time scan)"""
+        chat_dir = os.path.join(self.history_dir, session_id)
+        chat_ids = {
+            os.path.splitext(os.path.basename(filepath))[0]
+            for filepath in glob.glob(os.path.join(chat_dir, "*.jsonl")) + glob.glob(os.path.join(chat_dir, "*.json"))
+        }
+        chat_ids.discard(os.path.splitext(ChatIndex.FILENAME)[0])
+        for chat_id in chat_ids:
+            chat_data = self.get_chat(chat_id, session_id)
+            if chat_data:
+                index._apply(self._chat_summary(chat_data))
+        index.compact()
+
+    @staticmethod
+    def _chat_summary(chat: Dict) -> Dict:
+        """The fields listed for a chat in the sidebar"""
+        return {"chat_id": chat["chat_id"], "title": chat.get("title"), "dts": chat.get("dts", 0)}
+
+    @staticmethod
+    def _chat_fields(chat: Dict) -> Dict:
+        """The chat fields stored in the header/meta lines"""
+        return {key: value for key, value in chat.items() if key != "messages"}
+
+    @staticmethod
+    def _encode(record: Dict) -> bytes:
+        return (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+
+    def _read_log(self, filepath: str) -> tuple:
+        """
+        Replay a chat log into a chat dict.
+
+        A torn last line (from a crash mid-append) is ignored.
+
+        Returns:
+            tuple: (chat dict, number of meta lines)
+        """
+        chat_data = {}
+        messages = []
+        meta_count = 0
+        with open(filepath, 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    break
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    break
+                record_type = record.pop("type", None)
+                if record_type == "message":
+                    messages.append(record["message"])
+                elif record_type == "header":
+                    chat_data.update(record)
+                elif record_type == "meta":
+                    chat_data.update(record)
+                    meta_count += 1
+        if chat_data:
+            chat_data["messages"] = messages
+        return chat_data, meta_count
+
+    def _append_records(self, filepath: str, data: bytes) -> None:
+        """Append complete lines to a log and flush them to disk"""
+        fd = os.open(filepath, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            # Drop a torn last line left by a crash so new lines stay parseable
+            size = os.fstat(fd).st_size
+            if size and os.pread(fd, 1, size - 1) != b"\n":
+                with open(filepath, 'rb') as f:
+                    content = f.read()
+                os.ftruncate(fd, content.rfind(b"\n") + 1)
+            os.write(fd, data)
+            if CHAT_LOG_FSYNC:
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _write_log(self, filepath: str, chat: Dict) -> None:
+        """Write a complete, compacted log atomically"""
+        header = {"type": "header", **self._chat_fields(chat)}
+        data = self._encode(header) + b"".join(
+            self._encode({"type": "message", "message": message}) for message in chat["messages"]
+        )
+        tmp_path = f"{filepath}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            if CHAT_LOG_FSYNC:
+                os.fsync(f.fileno())
+        os.replace(tmp_path, filepath)
     
-    def _save_image(self, chat_id: str, message_id: str, image_data: str) -> str:
+    @staticmethod
+    def _iter_base64_chunks(image_data: str):
         """
-        Save image data to a file and return the relative path.
+        Decode base64 image data a chunk at a time.
+        
+        Yields the decoded bytes and never holds more than one chunk of the
+        decoded image in memory. Whitespace in the data is skipped.
+        """
+        start = image_data.find(',', 0, 256) + 1  # Skip a data URL header if present
+        remainder = ""
+        for offset in range(start, len(image_data), IMAGE_DECODE_CHUNK):
+            chunk = remainder + re.sub(r"\s", "", image_data[offset:offset + IMAGE_DECODE_CHUNK])
+            usable = len(chunk) - len(chunk) % 4
+            remainder = chunk[usable:]
+            if usable:
+                yield base64.b64decode(chunk[:usable])
+        if remainder:
+            yield base64.b64decode(remainder + "=" * (-len(remainder) % 4))
+
+    @staticmethod
+    def _image_extension(image_data: str, first_bytes: bytes) -> str:
+        """Pick the file extension from the image content, falling back to the data URL mime type"""
+        for signature, extension in IMAGE_SIGNATURES:
+            if first_bytes.startswith(signature):
+                return extension
+        if first_bytes[:4] == b"RIFF" and first_bytes[8:12] == b"WEBP":
+            return "webp"
+        header = image_data[:image_data.find(',', 0, 256) + 1]
+        if header.startswith("data:"):
+            mime_type = header[5:].split(';')[0].split(',')[0]
+            return IMAGE_MIME_EXTENSIONS.get(mime_type, "jpg")
+        return "jpg"  # default to JPEG if no header
+
+    def _store_image_blob(self, image_data: str) -> tuple:
+        """
+        Store image content once, keyed by its SHA-256 hash.
+        
+        The data is hashed first without touching the disk, so an image that is
+        already stored costs a single decode pass and no writes.
+        
+        Args:
+            image_data: Base64 encoded image data, optionally as a data URL
+        
+        Returns:
+            tuple: (path of the stored image, hex digest)
+        """
+        digest = hashlib.sha256()
+        first_bytes = b""
+        for chunk in self._iter_base64_chunks(image_data):
+            if len(first_bytes) < 16:
+                first_bytes += chunk[:16]
+            digest.update(chunk)
+        image_hash = digest.hexdigest()
+        extension = self._image_extension(image_data, first_bytes)
+        
+        blob_dir = os.path.join(self.images_dir, "blobs", image_hash[:2])
+        blob_path = os.path.join(blob_dir, f"{image_hash}.{extension}")
+        if not os.path.exists(blob_path):
+            os.makedirs(blob_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=blob_dir, suffix=".tmp")
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    for chunk in self._iter_base64_chunks(image_data):
+                        f.write(chunk)
+                os.replace(tmp_path, blob_path)
+            except Exception:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+        return blob_path, image_hash
+
+    def _save_image(self, chat_id: str, message_id: str, image_data: str) -> tuple:
+        """
+        Save image data and return the relative path and content hash.
+        
+        The image is stored once per distinct content (see _store_image_blob) in its
+        original format. The per-message path is a symlink to it, so the existing
+        images/{chat_id}/{message_id}.png URLs keep working.
         
         Args:
             chat_id: The chat ID
@@ -35,36 +409,26 @@ class ChatHistoryManager:
             image_data: Base64 encoded image data
         
         Returns:
-            str: Relative path to the saved image
+            tuple: Relative path to the saved image and its SHA-256 hash ("" on failure)
         """
         # Create chat-specific image directory
         chat_images_dir = os.path.join(self.images_dir, chat_id)
         os.makedirs(chat_images_dir, exist_ok=True)
         
-        # Save image to file
+        # Link the message image to the stored content
         image_path = os.path.join(chat_images_dir, f"{message_id}.png")
         try:
-            # Extract the actual base64 data and mime type
-            base64_string = image_data
-            if ',' in base64_string:
-                header, base64_data = base64_string.split(',', 1)
-                mime_type = header.split(':')[1].split(';')[0]
-            else:
-                base64_data = base64_string
-                mime_type = 'image/jpeg'  # default to JPEG if no header
-            
-            # Decode base64 to bytes
-            image_bytes = base64.b64decode(base64_data)
-            
-            with open(image_path, 'wb') as f:
-                f.write(image_bytes)
+            blob_path, image_hash = self._store_image_blob(image_data)
+            if os.path.lexists(image_path):
+                os.remove(image_path)
+            os.symlink(os.path.relpath(blob_path, chat_images_dir), image_path)
             
             # Return relative path from chat history root
-            return os.path.relpath(image_path, self.history_dir)
+            return os.path.relpath(image_path, self.history_dir), image_hash
         except Exception as e:
             print(f"Error saving image: {str(e)}")
             traceback.print_exc()
-            return ""
+            return "", ""
 
     def _load_image(self, relative_path: str) -> Optional[str]:
         """
@@ -87,65 +451,101 @@ class ChatHistoryManager:
             traceback.print_exc()
         return None
     
+    @track_dependency("chat_history", "save_chat")
     def save_chat(self, chat_to_save: Dict, session_id: str) -> None:
-        """Save a chat to both memory and file, handling images separately"""
+        """Save a chat to file, appending only what changed since the last save and handling images separately"""
         chat_dir = os.path.join(self.history_dir,session_id)
         os.makedirs(chat_dir, exist_ok=True)
+        chat_id = chat_to_save["chat_id"]
+        filepath = self._get_chat_filepath(chat_id, session_id)
+        
+        # Find out how much of the chat is already in the log
+        state = self._log_state.get((session_id, chat_id))
+        if state is None and os.path.exists(filepath):
+            persisted_chat, meta_count = self._read_log(filepath)
+            state = (len(persisted_chat.get("messages", [])), meta_count)
+        persisted_count, meta_count = state if state is not None else (0, 0)
+        if persisted_count > len(chat_to_save["messages"]):
+            # Messages were removed, the log has to be rewritten
+            persisted_count, state = 0, None
+        new_messages = chat_to_save["messages"][persisted_count:]
         
         # Process messages to save images separately
-        for message in chat_to_save["messages"]:
+        for message in new_messages:
             if "image" in message and message["image"] is not None:
                 #print("image:",message["image"])
                 # Save image and replace with path
-                image_path = self._save_image(
-                    chat_to_save["chat_id"],
+                image_path, image_hash = self._save_image(
+                    chat_id,
                     message["message_id"],
                     message["image"]
                 )
                 if image_path:
                     message["image_path"] = image_path
+                    message["image_hash"] = image_hash
                 del message["image"]
         
         # Save chat data
-        filepath = self._get_chat_filepath(chat_to_save["chat_id"], session_id)
         try:
-            with open(filepath, 'w', encoding='utf-8') as f:
-                json.dump(chat_to_save, f, indent=2, ensure_ascii=False)    
+            if state is None or meta_count >= CHAT_LOG_COMPACT_EVERY:
+                self._write_log(filepath, chat_to_save)
+                meta_count = 0
+                legacy_filepath = self._get_legacy_chat_filepath(chat_id, session_id)
+                if os.path.exists(legacy_filepath):
+                    os.remove(legacy_filepath)
+            else:
+                data = self._encode({"type": "meta", **self._chat_fields(chat_to_save)})
+                data += b"".join(
+                    self._encode({"type": "message", "message": message}) for message in new_messages
+                )
+                self._append_records(filepath, data)
+                meta_count += 1
+            self._remember_log_state(chat_id, session_id, len(chat_to_save["messages"]), meta_count)
+            self._get_index(session_id).update(self._chat_summary(chat_to_save))
         except Exception as e:
-            print(f"Error saving chat {chat_to_save['chat_id']}: {str(e)}")
+            print(f"Error saving chat {chat_id}: {str(e)}")
             traceback.print_exc()
             raise e
 
+    @track_dependency("chat_history", "get_chat")
     def get_chat(self, chat_id: str, session_id: str) -> Optional[Dict]:
         """Get a specific chat by ID"""
-        filepath = os.path.join(self.history_dir,session_id,f"{chat_id}.json")
+        filepath = self._get_chat_filepath(chat_id, session_id)
         chat_data = {}
         try:
-            with open(filepath, 'r', encoding='utf-8') as f:
-                chat_data = json.load(f)        
+            if os.path.exists(filepath):
+                chat_data, meta_count = self._read_log(filepath)
+                if chat_data:
+                    self._remember_log_state(chat_id, session_id, len(chat_data["messages"]), meta_count)
+            else:
+                # Chats saved before the log format
+                filepath = self._get_legacy_chat_filepath(chat_id, session_id)
+                with open(filepath, 'r', encoding='utf-8') as f:
+                    chat_data = json.load(f)
         except Exception as e:
             print(f"Error loading chat history from {filepath}: {str(e)}")
             traceback.print_exc()
         return chat_data
     
-    def get_recent_chats(self, session_id: str, limit: Optional[int] = None) -> List[Dict]:
-        """Get recent chats, optionally limited to a specific number"""        
-        chat_dir = os.path.join(self.history_dir,session_id)
-        os.makedirs(chat_dir, exist_ok=True)
-        recent_chats = []
-        chat_files = glob.glob(os.path.join(chat_dir,"*.json"))
-        for filepath in chat_files:
-            try:
-                with open(filepath, 'r', encoding='utf-8') as f:
-                    chat_data = json.load(f)        
-                    recent_chats.append(chat_data)
-            except Exception as e:
-                print(f"Error loading chat history from {filepath}: {str(e)}")
-                traceback.print_exc()
-
-        # Sort by dts
-        recent_chats.sort(key=lambda x: x.get('dts', 0), reverse=True)
-        if limit:
-            return recent_chats[:limit]
-
-        return recent_chats
+    @track_dependency("chat_history", "get_recent_chats")
+    def get_recent_chats(self, session_id: str, limit: Optional[int] = None, before: Optional[int] = None,
+                         before_id: Optional[str] = None) -> List[Dict]:
+        """
+        Get summaries (chat_id, title, dts) of the most recent chats.
+        
+        Args:
+            session_id: The session ID
+            limit: Maximum number of chats to return
+            before: dts of the last chat of the previous page (cursor for the next page)
+            before_id: chat_id of the last chat of the previous page; without it, chats
+                sharing the `before` dts are skipped
+        
+        Returns:
+            List[Dict]: Chat summaries, most recent first
+        """
+        try:
+            return self._get_index(session_id).page(limit, before, before_id)
+        except Exception as e:
+            print(f"Error loading chat index for session {session_id}: {str(e)}")
+            traceback.print_exc()
+            return []
@@ -0,0 +1,206 @@
+"""
+CNN inference backends for the cheese classifier.
+
+The Keras backend serves the trained model as is. The TFLite backend serves a
+quantized conversion of it (float16 or int8 weights), which loads faster, uses
+less memory and runs several times faster per image on CPU-only hosts.
+
+Check that a quantized model still agrees with the Keras model before serving it:
+
+    python -m api.utils.cnn_inference --model /persistent/experiments/experiments/mobilenetv2_train_base_True.keras \\
+        --images /path/to/held-out-images --quantization float16
+"""
+import os
+import json
+import time
+import argparse
+import numpy as np
+from typing import Dict, List, Optional
+import tensorflow as tf
+
+from api.utils.image_utils import preprocess_image, image_width, image_height, num_channels
+
+# Quantization modes for the TFLite backend
+QUANTIZATIONS = ("float16", "int8", "none")
+
+
+def with_softmax(model: tf.keras.Model) -> tf.keras.Model:
+    """The model with a softmax output, adding one if it returns logits"""
+    if model.layers[-1].activation.__name__ == "softmax":
+        return model
+    return tf.keras.Model(model.inputs, tf.keras.layers.Softmax()(model.outputs[0]))
+
+
+class KerasBackend:
+    """Serves the Keras model directly"""
+
+    name = "keras"
+
+    def __init__(self, model: tf.keras.Model):
+        self.model = with_softmax(model)
+
+    @classmethod
+    def load(cls, model_path: str) -> "KerasBackend":
+        """Load a saved Keras model"""
+        return cls(tf.keras.models.load_model(model_path))
+
+    def predict(self, images: np.ndarray) -> np.ndarray:
+        """Class probabilities for a batch of normalized images"""
+        return np.asarray(self.model.predict_on_batch(images))
+
+
+def tflite_path(keras_path: str, quantization: str) -> str:
+    """Where the converted model for a Keras model and quantization is cached"""
+    return f"{os.path.splitext(keras_path)[0]}.{quantization}.tflite"
+
+
+def convert_to_tflite(model: tf.keras.Model, quantization: str = "float16") -> bytes:
+    """
+    Convert a Keras model to TFLite.
+
+    Args:
+        model: The trained model
+        quantization: "float16" (half-size weights), "int8" (dynamic-range: int8
+            weights, float inputs and outputs) or "none"
+
+    Returns:
+        bytes: The TFLite flatbuffer
+    """
+    if quantization not in QUANTIZATIONS:
+        raise ValueError(f"Unknown quantization {quantization!r}, expected one of {QUANTIZATIONS}")
+    converter = tf.lite.TFLiteConverter.from_keras_model(with_softmax(model))
+    if quantization != "none":
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantization == "float16":
+        converter.target_spec.supported_types = [tf.float16]
+    return converter.convert()
+
+
+class TFLiteBackend:
+    """
+    Serves a converted TFLite model.
+
+    Interpreters are not thread safe and resizing one reallocates its tensors, so
+    one interpreter is kept per batch size; the batcher pads batches to powers of
+    two, which keeps that set small. The model file is memory-mapped, so the
+    interpreters share its weights.
+    """
+
+    name = "tflite"
+
+    def __init__(self, model_path: str, num_threads: Optional[int] = None):
+        self.model_path = model_path
+        self.num_threads = num_threads or os.cpu_count()
+        self._interpreters: Dict[int, tf.lite.Interpreter] = {}
+
+    @classmethod
+    def from_keras(cls, keras_path: str, quantization: str = "float16", num_threads: Optional[int] = None) -> "TFLiteBackend":
+        """Load the converted model for a Keras model, converting and caching it on first use"""
+        model_path = tflite_path(keras_path, quantization)
+        if not os.path.exists(model_path) or os.path.getmtime(model_path) < os.path.getmtime(keras_path):
+            print(f"Converting {keras_path} to TFLite ({quantization})...")
+            flatbuffer = convert_to_tflite(tf.keras.models.load_model(keras_path), quantization)
+            tmp_path = f"{model_path}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(flatbuffer)
+            os.replace(tmp_path, model_path)
+        return cls(model_path, num_threads)
+
+    def _interpreter(self, batch_size: int) -> tf.lite.Interpreter:
+        interpreter = self._interpreters.get(batch_size)
+        if interpreter is None:
+            interpreter = tf.lite.Interpreter(model_path=self.model_path, num_threads=self.num_threads)
+            input_index = interpreter.get_input_details()[0]["index"]
+            interpreter.resize_tensor_input(input_index, [batch_size, image_height, image_width, num_channels])
+            interpreter.allocate_tensors()
+            self._interpreters[batch_size] = interpreter
+        return interpreter
+
+    def predict(self, images: np.ndarray) -> np.ndarray:
+        """Class probabilities for a batch of normalized images"""
+        interpreter = self._interpreter(len(images))
+        interpreter.set_tensor(interpreter.get_input_details()[0]["index"], images.astype(np.float32, copy=False))
+        interpreter.invoke()
+        return interpreter.get_tensor(interpreter.get_output_details()[0]["index"]).copy()
+
+
+def _load_images(images_dir: str, label2index: Dict[str, int]) -> tuple:
+    """Held-out images and, when their folder names a class, their labels"""
+    paths, images, labels = [], [], []
+    for root, _, files in os.walk(images_dir):
+        for file in sorted(files):
+            path = os.path.join(root, file)
+            try:
+                with open(path, "rb") as f:
+                    images.append(preprocess_image(f.read()))
+            except (OSError, ValueError):
+                continue
+            paths.append(path)
+            labels.append(label2index.get(os.path.basename(root)))
+    return paths, np.stack(images).astype(np.float32) / 255, labels
+
+
+def _timed_predictions(backend, images: np.ndarray, batch_size: int) -> tuple:
+    backend.predict(images[:batch_size])  # Warm up
+    started = time.perf_counter()
+    outputs = [backend.predict(images[i:i + batch_size]) for i in range(0, len(images), batch_size)]
+    return np.concatenate(outputs), (time.perf_counter() - started) / len(images)
+
+
+def check_parity(keras_path: str, images_dir: str, quantization: str, batch_size: int = 1) -> Dict:
+    """
+    Compare the TFLite conversion of a model against the Keras model on held-out images.
+
+    Returns:
+        Dict: Top-1 agreement, accuracies (for images in class-named folders), probability
+        differences, per-image latency and model sizes for both backends
+    """
+    with open(os.path.join(os.path.dirname(keras_path), "data_details.json")) as f:
+        data_details = json.load(f)
+    label2index = {label: int(index) for index, label in data_details["index2label"].items()}
+    paths, images, labels = _load_images(images_dir, label2index)
+    if not paths:
+        raise ValueError(f"No readable images in {images_dir}")
+
+    keras_backend = KerasBackend.load(keras_path)
+    tflite_backend = TFLiteBackend.from_keras(keras_path, quantization)
+    keras_probs, keras_latency = _timed_predictions(keras_backend, images, batch_size)
+    tflite_probs, tflite_latency = _timed_predictions(tflite_backend, images, batch_size)
+
+    keras_top1 = keras_probs.argmax(axis=1)
+    tflite_top1 = tflite_probs.argmax(axis=1)
+    labelled = [i for i, label in enumerate(labels) if label is not None]
+    report = {
+        "images": len(paths),
+        "quantization": quantization,
+        "top1_agreement": float(np.mean(keras_top1 == tflite_top1)),
+        "max_prob_diff": float(np.max(np.abs(keras_probs - tflite_probs))),
+        "mean_prob_diff": float(np.mean(np.abs(keras_probs - tflite_probs))),
+        "keras_ms_per_image": round(keras_latency * 1000, 3),
+        "tflite_ms_per_image": round(tflite_latency * 1000, 3),
+        "keras_model_bytes": os.path.getsize(keras_path),
+        "tflite_model_bytes": os.path.getsize(tflite_backend.model_path),
+        "disagreements": [paths[i] for i in np.flatnonzero(keras_top1 != tflite_top1)],
+    }
+    if labelled:
+        report["keras_accuracy"] = float(np.mean([keras_top1[i] == labels[i] for i in labelled]))
+        report["tflite_accuracy"] = float(np.mean([tflite_top1[i] == labels[i] for i in labelled]))
+    return report
+
+
+def main(args=None):
+    report = check_parity(args.model, args.images, args.quantization, args.batch_size)
+    print(json.dumps(report, indent=2))
+    if report["top1_agreement"] < args.min_agreement:
+        print(f"Top-1 agreement {report['top1_agreement']:.4f} is below {args.min_agreement}")
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Accuracy parity check of the TFLite backend against the Keras model")
+    parser.add_argument("--model", required=True, help="Path of the Keras model (data_details.json must sit next to it)")
+    parser.add_argument("--images", required=True, help="Held-out images, optionally in folders named by class label")
+    parser.add_argument("--quantization", default="float16", choices=QUANTIZATIONS, help="TFLite quantization to check")
+    parser.add_argument("--batch-size", type=int, default=1, help="Images per forward pass when timing")
+    parser.add_argument("--min-agreement", type=float, default=0.99, help="Fail if top-1 agreement is lower")
+    main(parser.parse_args())
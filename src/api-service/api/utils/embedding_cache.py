@@ -0,0 +1,206 @@
+import os
+import re
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+import numpy as np
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional
+from fastapi.concurrency import run_in_threadpool
+
+# Cache settings
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.environ.get("EMBEDDING_CACHE_MAX_ENTRIES", "4096"))  # In memory
+EMBEDDING_CACHE_DIR = os.environ.get("EMBEDDING_CACHE_DIR", "")  # Enables the on-disk store when set
+EMBEDDING_CACHE_MAX_DISK_ENTRIES = int(os.environ.get("EMBEDDING_CACHE_MAX_DISK_ENTRIES", "1000000"))
+EMBEDDING_CACHE_BUSY_TIMEOUT = float(os.environ.get("EMBEDDING_CACHE_BUSY_TIMEOUT", "0.5"))  # Seconds to wait on another worker's lock
+
+
+def normalize_text(text: str) -> str:
+    """Canonical form of a query: NFC unicode with collapsed whitespace"""
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def embedding_cache_key(model_id: str, text: str) -> str:
+    return hashlib.sha256(f"{model_id}\n{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+
+class MmapEmbeddingStore:
+    """
+    Append-only on-disk embedding store for one model, shared by workers.
+
+    Vectors live in a flat float32 file that readers memory-map; a SQLite index
+    maps keys to rows. Writers take a SQLite write lock, write the vector, then
+    commit its index row, so readers never see a row before its data.
+    """
+
+    def __init__(self, directory: str, max_entries: int = EMBEDDING_CACHE_MAX_DISK_ENTRIES,
+                 busy_timeout: float = EMBEDDING_CACHE_BUSY_TIMEOUT):
+        os.makedirs(directory, exist_ok=True)
+        self.max_entries = max_entries
+        self.busy_timeout = busy_timeout
+        self.vectors_path = os.path.join(directory, "vectors.f32")
+        self.index_path = os.path.join(directory, "index.db")
+        self._local = threading.local()
+        self._mmap: Optional[np.memmap] = None
+        self._mmap_lock = threading.Lock()
+        conn = self._connection()
+        conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, row INTEGER NOT NULL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.index_path, timeout=self.busy_timeout, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _dimension(self) -> Optional[int]:
+        row = self._connection().execute("SELECT value FROM meta WHERE name = 'dimension'").fetchone()
+        return row[0] if row else None
+
+    def _rows(self, row: int, dimension: int) -> Optional[np.memmap]:
+        """Memory map of the vectors file, remapped when it has grown past `row`"""
+        with self._mmap_lock:
+            if self._mmap is None or self._mmap.shape[0] <= row or self._mmap.shape[1] != dimension:
+                rows = os.path.getsize(self.vectors_path) // (4 * dimension)
+                if rows <= row:
+                    return None
+                self._mmap = np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(rows, dimension))
+            return self._mmap
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        result = self._connection().execute("SELECT row FROM embeddings WHERE key = ?", (key,)).fetchone()
+        if result is None:
+            return None
+        dimension = self._dimension()
+        vectors = self._rows(result[0], dimension)
+        if vectors is None:
+            return None
+        return np.array(vectors[result[0]])
+
+    def put(self, key: str, vector: np.ndarray) -> None:
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if conn.execute("SELECT 1 FROM embeddings WHERE key = ?", (key,)).fetchone():
+                conn.execute("ROLLBACK")
+                return
+            dimension = self._dimension()
+            if dimension is None:
+                dimension = vector.shape[0]
+                conn.execute("INSERT INTO meta (name, value) VALUES ('dimension', ?)", (dimension,))
+            row = conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            if vector.shape[0] != dimension or row >= self.max_entries:
+                conn.execute("ROLLBACK")
+                return
+            fd = os.open(self.vectors_path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                os.pwrite(fd, vector.astype(np.float32).tobytes(), row * dimension * 4)
+            finally:
+                os.close(fd)
+            conn.execute("INSERT INTO embeddings (key, row) VALUES (?, ?)", (key, row))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+
+class EmbeddingCache:
+    """
+    Cache of query embeddings keyed by (model id, normalized text).
+
+    Holds float32 vectors in a bounded in-memory LRU. When EMBEDDING_CACHE_DIR is
+    set, misses fall through to a memory-mapped on-disk store per model that
+    survives restarts and is shared by workers.
+
+    Memory lookups stay on the event loop; the disk tier runs in the threadpool.
+    A disk store locked by another worker for longer than its busy timeout is
+    treated as a miss (or a skipped write) rather than waited on.
+    """
+
+    def __init__(self, max_entries: int = EMBEDDING_CACHE_MAX_ENTRIES, directory: str = EMBEDDING_CACHE_DIR,
+                 busy_timeout: float = EMBEDDING_CACHE_BUSY_TIMEOUT):
+        self.max_entries = max_entries
+        self.directory = directory
+        self.busy_timeout = busy_timeout
+        self._memory: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._stores: Dict[str, MmapEmbeddingStore] = {}
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.busy = 0
+
+    def _store(self, model_id: str) -> MmapEmbeddingStore:
+        """The disk store of a model, opened on first use (runs in the threadpool)"""
+        store = self._stores.get(model_id)
+        if store is None:
+            directory = os.path.join(self.directory, re.sub(r"[^\w.-]", "_", model_id))
+            store = MmapEmbeddingStore(directory, busy_timeout=self.busy_timeout)
+            store = self._stores.setdefault(model_id, store)
+        return store
+
+    def _read(self, model_id: str, key: str) -> Optional[np.ndarray]:
+        return self._store(model_id).get(key)
+
+    def _write(self, model_id: str, key: str, vector: np.ndarray) -> None:
+        self._store(model_id).put(key, vector)
+
+    def _remember(self, key: str, vector: np.ndarray) -> None:
+        with self._lock:
+            self._memory[key] = vector
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+    async def get(self, model_id: str, text: str) -> Optional[np.ndarray]:
+        key = embedding_cache_key(model_id, text)
+        with self._lock:
+            vector = self._memory.get(key)
+            if vector is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return vector
+        if self.directory:
+            try:
+                vector = await run_in_threadpool(self._read, model_id, key)
+            except sqlite3.OperationalError as e:
+                # Locked by another worker: calling the model beats waiting for the lock
+                print(f"Embedding cache unavailable ({str(e)}), treating as a miss")
+                self.busy += 1
+            if vector is not None:
+                self._remember(key, vector)
+                self.disk_hits += 1
+                return vector
+        self.misses += 1
+        return None
+
+    async def put(self, model_id: str, text: str, embedding: List[float]) -> None:
+        key = embedding_cache_key(model_id, text)
+        vector = np.asarray(embedding, dtype=np.float32)
+        self._remember(key, vector)
+        if self.directory:
+            try:
+                await run_in_threadpool(self._write, model_id, key, vector)
+            except sqlite3.OperationalError as e:
+                # The vector is still served from memory by this worker
+                print(f"Embedding cache unavailable ({str(e)}), not persisting the embedding")
+                self.busy += 1
+            except Exception as e:
+                print(f"Error storing embedding on disk: {str(e)}")
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_entries": len(self._memory),
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "busy": self.busy,
+            "hit_rate": round((self.memory_hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+        }
+
+
+embedding_cache = EmbeddingCache()
@@ -0,0 +1,178 @@
+import os
+import re
+import uuid
+import mimetypes
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Dict, Iterator, List, Optional, Tuple
+from fastapi import Request, Response
+from fastapi.responses import StreamingResponse
+
+# Bytes read from disk per chunk when streaming a file
+FILE_CHUNK_SIZE = 64 * 1024
+# Most ranges honoured in one request; longer Range headers are ignored
+MAX_RANGES = 16
+
+_DIGITS = re.compile(r"[0-9]+")
+
+
+def file_etag(stat: os.stat_result) -> str:
+    """Strong validator for a file version"""
+    return f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+
+def parse_range_header(range_header: str, file_size: int) -> Optional[List[Tuple[int, int]]]:
+    """
+    Parse a `Range: bytes=...` header into inclusive (start, end) pairs.
+
+    Overlapping and adjacent ranges are merged, so a file's bytes are sent at most
+    once per response.
+
+    Returns:
+        Optional[List[Tuple[int, int]]]: The satisfiable ranges in file order (empty if
+        none are), or None if the header is malformed, not in bytes or asks for more
+        than MAX_RANGES ranges, in which case it is ignored
+    """
+    unit, _, specs = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or not specs:
+        return None
+    specs = specs.split(",")
+    if len(specs) > MAX_RANGES:
+        return None
+    ranges = []
+    for spec in specs:
+        start, sep, end = spec.strip().partition("-")
+        # Plain digits only: int() would also accept signs, e.g. the negative suffix in "bytes=--5"
+        if not sep or not (start or end) or not all(_DIGITS.fullmatch(part) for part in (start, end) if part):
+            return None
+        if start == "":
+            # Suffix range: the last N bytes
+            length = int(end)
+            if length == 0:
+                return None
+            if file_size > 0:
+                ranges.append((max(file_size - length, 0), file_size - 1))
+            continue
+        start = int(start)
+        end = int(end) if end else file_size - 1
+        if start >= file_size:
+            continue
+        if start > end:
+            return None
+        ranges.append((start, min(end, file_size - 1)))
+
+    merged: List[Tuple[int, int]] = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def _if_range_matches(if_range: str, etag: str, stat: os.stat_result) -> bool:
+    """Whether the client's cached copy (named by If-Range) is still the current file"""
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith("W/"):
+        return if_range == etag
+    try:
+        return int(parsedate_to_datetime(if_range).timestamp()) >= int(stat.st_mtime)
+    except (TypeError, ValueError):
+        return False
+
+
+def _read_ranges(path: str, ranges: List[Tuple[int, int]], parts: Optional[List[bytes]] = None, closing: bytes = b"") -> Iterator[bytes]:
+    """Stream byte ranges from a file, optionally preceded by multipart part headers"""
+    with open(path, 'rb') as f:
+        for index, (start, end) in enumerate(ranges):
+            if parts:
+                yield parts[index]
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = f.read(min(FILE_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+    if closing:
+        yield closing
+
+
+def range_file_response(request: Request, path: str, media_type: Optional[str] = None, filename: Optional[str] = None) -> Response:
+    """
+    Serve a file with HTTP range and conditional request support.
+
+    Handles single and multiple byte ranges (206, multipart/byteranges), If-Range,
+    If-None-Match and If-Modified-Since (304), and unsatisfiable ranges (416). The
+    file is sent inline, so browsers can play or display it in place.
+
+    Args:
+        request: The incoming request (its headers select the response)
+        path: Path of the file to serve
+        media_type: Content type, guessed from the file name if omitted
+        filename: Name to report in Content-Disposition
+
+    Returns:
+        Response: The file response
+    """
+    stat = os.stat(path)
+    file_size = stat.st_size
+    etag = file_etag(stat)
+    if media_type is None:
+        media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    headers: Dict[str, str] = {
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+        "Last-Modified": formatdate(stat.st_mtime, usegmt=True),
+        "Content-Disposition": f'inline; filename="{filename or os.path.basename(path)}"',
+    }
+
+    # Conditional GET
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        if etag in [tag.strip() for tag in if_none_match.split(",")] or if_none_match.strip() == "*":
+            return Response(status_code=304, headers=headers)
+    elif request.headers.get("if-modified-since"):
+        try:
+            if int(stat.st_mtime) <= parsedate_to_datetime(request.headers["if-modified-since"]).timestamp():
+                return Response(status_code=304, headers=headers)
+        except (TypeError, ValueError):
+            pass
+
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    ranges = None
+    if range_header and (if_range is None or _if_range_matches(if_range, etag, stat)):
+        ranges = parse_range_header(range_header, file_size)
+
+    if ranges is None:
+        headers["Content-Length"] = str(file_size)
+        return StreamingResponse(_read_ranges(path, [(0, file_size - 1)] if file_size else []), media_type=media_type, headers=headers)
+
+    if not ranges:
+        headers["Content-Range"] = f"bytes */{file_size}"
+        return Response(status_code=416, headers=headers)
+
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        headers["Content-Range"] = f"bytes {start}-{end}/{file_size}"
+        headers["Content-Length"] = str(end - start + 1)
+        return StreamingResponse(_read_ranges(path, ranges), status_code=206, media_type=media_type, headers=headers)
+
+    # Multiple ranges go in a multipart/byteranges body
+    boundary = uuid.uuid4().hex
+    parts = [
+        (f"--{boundary}\r\nContent-Type: {media_type}\r\nContent-Range: bytes {start}-{end}/{file_size}\r\n\r\n").encode("latin-1")
+        for start, end in ranges
+    ]
+    parts = [parts[0]] + [b"\r\n" + part for part in parts[1:]]
+    closing = f"\r\n--{boundary}--\r\n".encode("latin-1")
+    headers["Content-Length"] = str(
+        sum(len(part) for part in parts) + sum(end - start + 1 for start, end in ranges) + len(closing)
+    )
+    return StreamingResponse(
+        _read_ranges(path, ranges, parts, closing),
+        status_code=206,
+        media_type=f"multipart/byteranges; boundary={boundary}",
+        headers=headers
+    )
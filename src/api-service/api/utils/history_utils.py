@@ -0,0 +1,188 @@
+import os
+import traceback
+from typing import Dict, Any, List, Optional, Callable
+from api.utils.bedrock_utils import invoke_model
+
+# Compaction settings
+HISTORY_TOKEN_BUDGET = int(os.environ.get("HISTORY_TOKEN_BUDGET", "12000"))  # Estimated tokens kept per chat session
+HISTORY_COMPACT_TARGET = float(os.environ.get("HISTORY_COMPACT_TARGET", "0.75"))  # Compact down to this fraction of the budget
+HISTORY_KEEP_MESSAGES = int(os.environ.get("HISTORY_KEEP_MESSAGES", "6"))  # Most recent messages, always kept verbatim
+HISTORY_SUMMARIZE = os.environ.get("HISTORY_SUMMARIZE", "1") == "1"  # Summarize dropped turns instead of discarding them
+HISTORY_SUMMARY_MAX_TOKENS = 500
+
+# Rough token estimates; exact counts would need a tokenizer call per message
+CHARS_PER_TOKEN = 4
+MESSAGE_OVERHEAD_TOKENS = 4
+IMAGE_TOKENS = 1600
+# Estimate stored with each message once counted, so later turns only count new messages.
+# It is not part of the Bedrock message format: request bodies use `request_messages`.
+TOKENS_KEY = "_tokens"
+
+SUMMARY_PREFIX = "Summary of our conversation so far:"
+SUMMARY_ACKNOWLEDGEMENT = "Understood. I will keep this earlier context in mind."
+IMAGE_PLACEHOLDER = "[The user shared an image]"
+
+SUMMARY_INSTRUCTION = """
+You maintain a running summary of a conversation between a user and a cheese expert assistant.
+Merge the previous summary (if any) with the new messages into one concise summary.
+Keep the facts, names, preferences and open questions the assistant needs to continue the conversation.
+Answer with the summary only.
+"""
+
+
+def content_text(content: Any) -> str:
+    """Plain text of message content, whether a string or a list of content blocks"""
+    if isinstance(content, str):
+        return content
+    return "\n".join(block["text"] for block in content if block.get("type") == "text")
+
+
+def message_tokens(message: Dict) -> int:
+    """Estimated token count of one message"""
+    content = message["content"]
+    if isinstance(content, str):
+        return MESSAGE_OVERHEAD_TOKENS + len(content) // CHARS_PER_TOKEN + 1
+    tokens = MESSAGE_OVERHEAD_TOKENS
+    for block in content:
+        if block.get("type") == "text":
+            tokens += len(block["text"]) // CHARS_PER_TOKEN + 1
+        else:
+            tokens += IMAGE_TOKENS
+    return tokens
+
+
+def counted_tokens(message: Dict) -> int:
+    """Estimated token count of one message, counted on first use and then stored with it"""
+    tokens = message.get(TOKENS_KEY)
+    if tokens is None:
+        tokens = message[TOKENS_KEY] = message_tokens(message)
+    return tokens
+
+
+def request_messages(chat_session: List[Dict]) -> List[Dict]:
+    """The messages of a session as Bedrock expects them, without the stored token counts"""
+    return [
+        {key: value for key, value in message.items() if key != TOKENS_KEY} if TOKENS_KEY in message else message
+        for message in chat_session
+    ]
+
+
+def strip_images(message: Dict) -> Dict:
+    """Replace image blocks in an older message with a text placeholder"""
+    content = message["content"]
+    if isinstance(content, str) or all(block.get("type") == "text" for block in content):
+        return message
+    return {
+        **message,
+        "content": [
+            block if block.get("type") == "text" else {"type": "text", "text": IMAGE_PLACEHOLDER}
+            for block in content
+        ]
+    }
+
+
+def has_summary(chat_session: List[Dict]) -> bool:
+    """Whether the session starts with a summary of compacted turns"""
+    return (
+        len(chat_session) >= 2
+        and isinstance(chat_session[0]["content"], str)
+        and chat_session[0]["content"].startswith(SUMMARY_PREFIX)
+    )
+
+
+async def summarize_messages(model_id: str, previous_summary: str, messages: List[Dict]) -> str:
+    """Fold dropped messages into the running summary"""
+    transcript = "\n\n".join(f"{message['role']}: {content_text(message['content'])}" for message in messages)
+    prompt = f"Previous summary:\n{previous_summary or '(none)'}\n\nNew messages:\n{transcript}"
+    response_body = await invoke_model(model_id, {
+        "anthropic_version": "bedrock-2023-05-31",
+        "system": SUMMARY_INSTRUCTION,
+        "messages": [{"role": "user", "content": prompt}],
+        "max_tokens": HISTORY_SUMMARY_MAX_TOKENS,
+        "temperature": 0.0,
+    })
+    return response_body['content'][0]['text']
+
+
+async def compact_history(
+    chat_session: List[Dict],
+    model_id: str,
+    strip: Optional[Callable[[Dict], Dict]] = None,
+    budget: int = HISTORY_TOKEN_BUDGET
+) -> None:
+    """
+    Keep a chat session within a token budget, in place.
+
+    Nothing happens while the session fits the budget. Once it does not, the session
+    is brought down to HISTORY_COMPACT_TARGET of the budget, so compaction (and any
+    summary call) runs only every few turns:
+
+    1. The last HISTORY_KEEP_MESSAGES messages are never touched
+    2. Older messages are reduced with `strip` (e.g. dropping retrieved context)
+    3. The oldest turns are dropped and, with HISTORY_SUMMARIZE, folded into a summary
+       kept as the first user/assistant pair of the session
+
+    Args:
+        chat_session: The Bedrock messages of the chat, ending on an assistant turn
+        model_id: Model used to write the summary
+        strip: Reduces an older message to what later turns still need
+        budget: Maximum estimated tokens for the session
+    """
+    # Only messages added since the last turn are counted; the rest carry their count
+    tokens = [counted_tokens(message) for message in chat_session]
+    total = sum(tokens)
+    if total <= budget:
+        return
+
+    target = int(budget * HISTORY_COMPACT_TARGET)
+    start = 2 if has_summary(chat_session) else 0
+    # First message kept verbatim; start it on a user turn so roles keep alternating
+    keep_from = max(len(chat_session) - HISTORY_KEEP_MESSAGES, start)
+    while start < keep_from < len(chat_session) and chat_session[keep_from]["role"] != "user":
+        keep_from -= 1
+
+    # Reduce older messages
+    if strip is not None:
+        for i in range(start, keep_from):
+            stripped = strip(chat_session[i])
+            if stripped is chat_session[i]:
+                continue
+            # A stripped copy may carry the count of the original, so count it afresh
+            stripped[TOKENS_KEY] = reduced = message_tokens(stripped)
+            chat_session[i] = stripped
+            total -= tokens[i] - reduced
+            tokens[i] = reduced
+        if total <= target:
+            return
+
+    # Drop the oldest whole turns
+    drop_to = start
+    while drop_to < keep_from and total > target:
+        total -= tokens[drop_to]
+        drop_to += 1
+    while drop_to < keep_from and chat_session[drop_to]["role"] != "user":
+        drop_to += 1
+    dropped = chat_session[start:drop_to]
+    if not dropped:
+        return
+
+    if not HISTORY_SUMMARIZE:
+        del chat_session[start:drop_to]
+        return
+
+    previous_summary = chat_session[0]["content"][len(SUMMARY_PREFIX):].strip() if start else ""
+    try:
+        summary = await summarize_messages(model_id, previous_summary, dropped)
+    except Exception as e:
+        # Dropping without a summary still keeps the request within the context window
+        print(f"Error summarizing chat history: {str(e)}")
+        traceback.print_exc()
+        del chat_session[start:drop_to]
+        return
+    summary_turn = [
+        {"role": "user", "content": f"{SUMMARY_PREFIX}\n{summary}"},
+        {"role": "assistant", "content": SUMMARY_ACKNOWLEDGEMENT},
+    ]
+    for message in summary_turn:
+        counted_tokens(message)
+    chat_session[:drop_to] = summary_turn
@@ -0,0 +1,224 @@
+import os
+import io
+import hashlib
+import tempfile
+import threading
+import traceback
+from typing import Dict, Optional, Tuple
+from fastapi import HTTPException, Response
+from fastapi.responses import FileResponse
+from fastapi.concurrency import run_in_threadpool
+import numpy as np
+from PIL import Image, ImageOps
+
+# Input size of the CNN classifier
+image_width = 224
+image_height = 224
+num_channels = 3
+
+# Variant settings
+IMAGE_CACHE_DIR = os.environ.get("IMAGE_CACHE_DIR", "image-cache")
+IMAGE_CACHE_MAX_BYTES = int(os.environ.get("IMAGE_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+
+# Longest side in pixels for each named variant
+IMAGE_VARIANT_SIZES = {
+    "thumb": 160,
+    "medium": 640,
+}
+# Output format -> (Pillow format, media type, file extension)
+IMAGE_VARIANT_FORMATS = {
+    "webp": ("WEBP", "image/webp", "webp"),
+    "jpeg": ("JPEG", "image/jpeg", "jpg"),
+}
+IMAGE_VARIANT_QUALITY = 80
+
+
+def resize_bilinear(pixels: np.ndarray, height: int, width: int) -> np.ndarray:
+    """
+    Bilinear resize with half-pixel centers and no antialiasing, as tf.image.resize does.
+
+    Only the source rows that are sampled are converted to float, so large photos
+    are not copied in full.
+
+    Returns:
+        np.ndarray: The resized pixels as a (height, width, channels) float32 array
+    """
+    def sample(out_size: int, in_size: int) -> tuple:
+        position = (np.arange(out_size, dtype=np.float32) + 0.5) * (in_size / out_size) - 0.5
+        position = np.clip(position, 0, in_size - 1)
+        low = np.floor(position).astype(np.intp)
+        high = np.minimum(low + 1, in_size - 1)
+        return low, high, (position - low).astype(np.float32)
+
+    top, bottom, row_weight = sample(height, pixels.shape[0])
+    left, right, col_weight = sample(width, pixels.shape[1])
+    upper = pixels[top].astype(np.float32)
+    rows = upper + (pixels[bottom].astype(np.float32) - upper) * row_weight[:, None, None]
+    return rows[:, left] + (rows[:, right] - rows[:, left]) * col_weight[None, :, None]
+
+
+def preprocess_image(image_bytes: bytes) -> np.ndarray:
+    """
+    Decode an uploaded image (JPEG, PNG, WebP, ...) straight from its bytes.
+
+    The image is fully decoded and resized the way the model's training data was
+    (tf.image.decode_jpeg + tf.image.resize), so it sees the same pixels at serving
+    time: no JPEG draft-mode downscaling and no antialiasing.
+
+    Returns:
+        np.ndarray: The resized RGB pixels (0-255) as a (height, width, channels) float32 array
+    """
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        pixels = np.asarray(image.convert("RGB"))
+    return resize_bilinear(pixels, image_height, image_width)
+
+
+class ImageVariantCache:
+    """
+    Resized copies of images, generated on first request and cached on disk.
+
+    Variants are keyed by the source file identity (path, size, mtime) and the
+    requested size and format, so a changed source gets new variants. The key
+    doubles as a strong ETag. The cache directory is kept under `max_bytes` by
+    deleting the least recently served variants.
+    """
+
+    def __init__(self, cache_dir: str = IMAGE_CACHE_DIR, max_bytes: int = IMAGE_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self.total_bytes = sum(size for _, size, _ in self._scan())
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _scan(self):
+        """Yield (path, size, last used) for every cached variant"""
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, stat.st_size, stat.st_mtime
+
+    @staticmethod
+    def variant_key(source_path: str, size: str, fmt: str) -> str:
+        stat = os.stat(source_path)
+        identity = f"{os.path.realpath(source_path)}:{stat.st_size}:{stat.st_mtime_ns}:{size}:{fmt}"
+        return hashlib.sha256(identity.encode("utf-8")).hexdigest()
+
+    def _variant_path(self, key: str, fmt: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.{IMAGE_VARIANT_FORMATS[fmt][2]}")
+
+    def _render(self, source_path: str, variant_path: str, size: str, fmt: str) -> int:
+        """Resize the source image into the variant file and return its size in bytes"""
+        pil_format = IMAGE_VARIANT_FORMATS[fmt][0]
+        max_side = IMAGE_VARIANT_SIZES[size]
+        with Image.open(source_path) as image:
+            image.draft("RGB", (max_side, max_side))  # Lets JPEG decode at reduced scale
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((max_side, max_side))
+            if pil_format == "JPEG" and image.mode not in ("RGB", "L"):
+                image = image.convert("RGB")
+            os.makedirs(os.path.dirname(variant_path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(variant_path), suffix=".tmp")
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    image.save(f, format=pil_format, quality=IMAGE_VARIANT_QUALITY)
+                os.replace(tmp_path, variant_path)
+            except Exception:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+        return os.path.getsize(variant_path)
+
+    def _evict(self) -> None:
+        """Delete least recently served variants until the cache is within budget"""
+        with self._lock:
+            if self.total_bytes <= self.max_bytes:
+                return
+            target = self.max_bytes * 0.9
+            for path, size, _ in sorted(self._scan(), key=lambda entry: entry[2]):
+                if self.total_bytes <= target:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    continue
+                self.total_bytes -= size
+                self.evictions += 1
+
+    def get_variant(self, source_path: str, size: str, fmt: str) -> Tuple[str, str]:
+        """
+        Get the path of a resized variant, generating it if needed (blocking).
+
+        Returns:
+            Tuple[str, str]: Variant file path and its ETag key
+        """
+        key = self.variant_key(source_path, size, fmt)
+        variant_path = self._variant_path(key, fmt)
+        if os.path.exists(variant_path):
+            self.hits += 1
+            os.utime(variant_path)  # Mark as recently used
+            return variant_path, key
+        self.misses += 1
+        variant_bytes = self._render(source_path, variant_path, size, fmt)
+        with self._lock:
+            self.total_bytes += variant_bytes
+        self._evict()
+        return variant_path, key
+
+    def stats(self) -> Dict:
+        return {
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+# Shared by all image endpoints
+image_variants = ImageVariantCache()
+
+
+async def image_variant_response(source_path: str, size: str, fmt: str = "webp", if_none_match: Optional[str] = None) -> Response:
+    """
+    Serve a resized variant of an image with a strong ETag.
+
+    Args:
+        source_path: Path of the original image
+        size: Variant name (see IMAGE_VARIANT_SIZES)
+        fmt: Output format (see IMAGE_VARIANT_FORMATS)
+        if_none_match: The request's If-None-Match header
+
+    Returns:
+        Response: The variant, or 304 Not Modified if the client already has it
+    """
+    if size not in IMAGE_VARIANT_SIZES:
+        raise HTTPException(status_code=400, detail=f"Unknown image size: {size}")
+    if fmt not in IMAGE_VARIANT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unknown image format: {fmt}")
+
+    etag = f'"{image_variants.variant_key(source_path, size, fmt)}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": "public, max-age=86400",
+    }
+    if if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+
+    try:
+        variant_path, _ = await run_in_threadpool(image_variants.get_variant, source_path, size, fmt)
+    except Exception as e:
+        print(f"Error creating image variant for {source_path}: {str(e)}")
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=f"Error resizing image: {str(e)}")
+    return FileResponse(
+        path=variant_path,
+        media_type=IMAGE_VARIANT_FORMATS[fmt][1],
+        headers=headers
+    )
@@ -1,39 +1,39 @@
 import os
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, AsyncIterator
 from fastapi import HTTPException
 import base64
 import io
 from PIL import Image
 from pathlib import Path
 import traceback
-import chromadb
+import asyncio
 # from vertexai.language_models import TextEmbeddingInput, TextEmbeddingModel
 # from vertexai.generative_models import GenerativeModel, ChatSession, Part
-import boto3
-from botocore.config import Config
+import json
+import hashlib
+from array import array
+from fastapi.concurrency import run_in_threadpool
+from api.utils.bedrock_utils import invoke_model
+from api.utils.response_cache import invoke_model_cached, invoke_model_stream_cached
+from api.utils.semantic_cache import SemanticCache, SEMANTIC_CACHE_ENABLED
+from api.utils.embedding_cache import embedding_cache, normalize_text
+from api.utils.singleflight import SingleFlight
+from api.utils.request_context import cache_bypass
+from api.utils.session_store import create_session_store
+from api.utils.history_utils import compact_history, request_messages
+from api.utils.metrics import track_dependency
 
 # Setup
-# Update environment variables and setup
-AWS_REGION = os.environ.get("AWS_DEFAULT_REGION", "us-east-1").strip()
-AWS_ACCESS_KEY_ID = os.environ.get("AWS_ACCESS_KEY_ID").strip()
-AWS_SECRET_ACCESS_KEY = os.environ.get("AWS_SECRET_ACCESS_KEY").strip()
-
 EMBEDDING_MODEL = "amazon.titan-embed-text-v1"
 GENERATIVE_MODEL = "anthropic.claude-3-sonnet-20240229-v1:0"
 CHROMADB_HOST = os.environ["CHROMADB_HOST"]
 CHROMADB_PORT = os.environ["CHROMADB_PORT"]
-
-# Initialize AWS Bedrock client
-bedrock = boto3.client(
-    service_name='bedrock-runtime',
-    region_name=AWS_REGION,
-    aws_access_key_id=AWS_ACCESS_KEY_ID,
-    aws_secret_access_key=AWS_SECRET_ACCESS_KEY
-)
+CHROMADB_RETRY_SECONDS = float(os.environ.get("CHROMADB_RETRY_SECONDS", "2"))  # First delay between connection attempts
+CHROMADB_RETRY_MAX_SECONDS = float(os.environ.get("CHROMADB_RETRY_MAX_SECONDS", "30"))
 
 # Configuration settings for the content generation
 generation_config = {
-    "max_output_tokens": 3000,  # Maximum number of tokens for output
+    "max_tokens": 3000,  # Maximum number of tokens for output
     "temperature": 0.1,  # Control randomness in output
     "top_p": 0.95,  # Use nucleus sampling
 }
@@ -66,82 +66,195 @@ Your goal is to provide accurate, helpful information about cheese based solely
 # embedding_model = TextEmbeddingModel.from_pretrained(EMBEDDING_MODEL)
 
 # Initialize chat sessions
-chat_sessions: Dict[str, List[Dict]] = {}
+chat_sessions = create_session_store("llm-rag")
+
 
+# Answers to first-turn questions, matched by query embedding
+semantic_cache = SemanticCache()
 
-# Connect to chroma DB
-client = chromadb.HttpClient(host=CHROMADB_HOST, port=CHROMADB_PORT)
+# Concurrent identical embedding and retrieval calls share one upstream call
+embedding_flights = SingleFlight("embedding")
+query_flights = SingleFlight("chroma_query")
+
+# Chroma DB collection, connected in the background at startup
 method = "recursive-split"
 collection_name = f"{method}-collection"
-# Get the collection
-collection = client.get_collection(name=collection_name)
+collection = None
+chromadb_status: Dict[str, Any] = {"state": "connecting", "attempts": 0, "error": None}
+
+
+def connect_chromadb():
+    """Connect to the vector DB and get the collection (blocking)"""
+    import chromadb
 
-def generate_query_embedding(query: str) -> List[float]:
-    """Generate embeddings using AWS Bedrock Titan model"""
-    body = json.dumps({"inputText": query})
-    response = bedrock.invoke_model(
-        modelId=EMBEDDING_MODEL,
-        body=body
-    )
-    response_body = json.loads(response['body'].read())
-    return response_body['embedding']
+    client = chromadb.HttpClient(host=CHROMADB_HOST, port=CHROMADB_PORT)
+    return client.get_collection(name=collection_name)
+
+
+async def connect_chromadb_in_background() -> None:
+    """Connect to the vector DB, retrying with backoff until it is reachable"""
+    global collection
+    delay = CHROMADB_RETRY_SECONDS
+    while collection is None:
+        chromadb_status["attempts"] += 1
+        try:
+            collection = await run_in_threadpool(connect_chromadb)
+        except Exception as e:
+            print(f"ChromaDB not available ({str(e)}), retrying in {delay:g}s")
+            chromadb_status["error"] = str(e)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, CHROMADB_RETRY_MAX_SECONDS)
+    chromadb_status.update(state="connected", error=None)
+    print(f"Connected to ChromaDB collection {collection_name}")
+
+
+def get_collection():
+    """The vector DB collection; rejects requests until it is connected"""
+    if collection is None:
+        raise HTTPException(
+            status_code=503,
+            detail="The vector database is not connected yet, please retry shortly",
+            headers={"Retry-After": "5"}
+        )
+    return collection
+
+
+async def generate_query_embedding(query: str) -> List[float]:
+    """Generate embeddings using AWS Bedrock Titan model, reusing cached vectors for repeated queries"""
+    query = normalize_text(query)
+    cached = await embedding_cache.get(EMBEDDING_MODEL, query)
+    if cached is not None:
+        return cached.tolist()
+
+    async def embed():
+        response_body = await invoke_model(EMBEDDING_MODEL, {"inputText": query}, hedge=True)
+        await embedding_cache.put(EMBEDDING_MODEL, query, response_body['embedding'])
+        return response_body['embedding']
+    return await embedding_flights.do(query, embed)
+
+
+async def query_collection(query_embedding: List[float], n_results: int = 5) -> Dict:
+    """Query the vector DB, sharing the result between concurrent identical queries"""
+    chroma_collection = get_collection()
+    key = f"{n_results}:{hashlib.sha256(array('d', query_embedding).tobytes()).hexdigest()}"
+
+    def query():
+        with track_dependency("chroma", "query"):
+            return chroma_collection.query(query_embeddings=[query_embedding], n_results=n_results)
+    return await query_flights.do(key, lambda: run_in_threadpool(query))
 
 
 def create_chat_session() -> List[Dict]:
     """Create a new chat session"""
-    return [{"role": "system", "content": SYSTEM_INSTRUCTION}]
+    return []  # System instruction is sent separately in the request body
 
 
-def generate_chat_response(chat_session: List[Dict], message: Dict) -> str:
+async def prepare_chat_request(chat_session: List[Dict], message: Dict, query_embedding: Optional[List[float]] = None) -> tuple:
+    """
+    Build the message list to send to Claude for a new user message, with retrieved context.
+    
+    The chat session itself is left unchanged; the exchange is added to it once the
+    response has been generated, so a failed call does not leave a dangling user turn.
+    
+    Returns:
+        tuple: (messages, retrieval) where retrieval holds the query embedding
+        (empty without text content)
+    """
+    messages = chat_session.copy()
+    retrieval = {}
+    
+    # Handle image processing (similar to before, but format for Claude)
+    if message.get("image"):
+        # Convert base64 to Claude's image format
+        # ... (image processing logic remains similar)
+        pass
+        
+    # Handle text content
+    if message.get("content"):
+        if query_embedding is None:
+            query_embedding = await generate_query_embedding(message["content"])
+        results = await query_collection(query_embedding, n_results=5)
+        # The question and its retrieved chunks go in separate blocks, so the chunks can be stripped later
+        message_content = [
+            {"type": "text", "text": message["content"]},
+            {"type": "text", "text": "\n".join(results["documents"][0])},
+        ]
+        messages.append({"role": "user", "content": message_content})
+        retrieval = {"embedding": query_embedding}
+    
+    return messages, retrieval
+
+
+async def lookup_semantic_cache(chat_session: List[Dict], message: Dict) -> tuple:
+    """
+    Look up a cached answer for a first-turn question with a similar embedding.
+    
+    On a hit the question and answer are added to the chat session.
+    
+    Returns:
+        tuple: (cached answer or None, query embedding or None)
+    """
+    if chat_session or not message.get("content") or not SEMANTIC_CACHE_ENABLED or cache_bypass.get():
+        return None, None
+    query_embedding = await generate_query_embedding(message["content"])
+    entry = semantic_cache.lookup(query_embedding)
+    if entry is None:
+        return None, query_embedding
+    print(f"Semantic cache hit ({entry['similarity']:.3f}): {entry['query']}")
+    chat_session.append({"role": "user", "content": message["content"]})
+    chat_session.append({"role": "assistant", "content": entry["answer"]})
+    return entry["answer"], query_embedding
+
+
+def strip_retrieved_context(message: Dict) -> Dict:
+    """Reduce an older question to its text, without the chunks retrieved for it"""
+    if message["role"] != "user" or isinstance(message["content"], str):
+        return message
+    return {"role": "user", "content": message["content"][0]["text"]}
+
+
+def update_semantic_cache(first_turn: bool, message: Dict, retrieval: Dict, answer: str) -> None:
+    """Remember the answer to a first-turn question"""
+    if first_turn and retrieval and SEMANTIC_CACHE_ENABLED and not cache_bypass.get():
+        semantic_cache.add(retrieval["embedding"], message["content"], answer)
+
+
+def build_request_body(chat_session: List[Dict]) -> Dict:
+    """Prepare request for Claude"""
+    return {
+        "anthropic_version": "bedrock-2023-05-31",
+        "system": SYSTEM_INSTRUCTION,
+        "messages": request_messages(chat_session),
+        "max_tokens": generation_config["max_tokens"],
+        "temperature": generation_config["temperature"],
+        "top_p": generation_config["top_p"]
+    }
+
+
+async def generate_chat_response(chat_session: List[Dict], message: Dict) -> str:
     """Generate a response using AWS Bedrock Claude model"""
     try:
-        # Process message content and images similar to before
-        message_parts = []
-        
-        # Handle image processing (similar to before, but format for Claude)
-        if message.get("image"):
-            # Convert base64 to Claude's image format
-            # ... (image processing logic remains similar)
-            pass
-            
-        # Handle text content
-        if message.get("content"):
-            query_embedding = generate_query_embedding(message["content"])
-            results = collection.query(
-                query_embeddings=[query_embedding],
-                n_results=5
-            )
-            message_content = f"""
-            {message["content"]}
-            {"\n".join(results["documents"][0])}
-            """
-            message_parts.append({"role": "user", "content": message_content})
-        
-        # Update chat session with new message
-        chat_session.extend(message_parts)
+        first_turn = not chat_session
+        cached_answer, query_embedding = await lookup_semantic_cache(chat_session, message)
+        if cached_answer is not None:
+            return cached_answer
         
-        # Prepare request for Claude
-        body = json.dumps({
-            "anthropic_version": "bedrock-2023-05-31",
-            "messages": chat_session,
-            "max_tokens": generation_config["max_tokens"],
-            "temperature": generation_config["temperature"],
-            "top_p": generation_config["top_p"]
-        })
+        messages, retrieval = await prepare_chat_request(chat_session, message, query_embedding)
         
         # Call Claude
-        response = bedrock.invoke_model(
-            modelId=GENERATIVE_MODEL,
-            body=body
-        )
-        response_body = json.loads(response['body'].read())
+        response_body = await invoke_model_cached(GENERATIVE_MODEL, build_request_body(messages))
         
-        # Add assistant's response to chat history
+        # Add the exchange to the chat history
         assistant_message = response_body['content'][0]['text']
+        chat_session.extend(messages[len(chat_session):])
         chat_session.append({"role": "assistant", "content": assistant_message})
+        update_semantic_cache(first_turn, message, retrieval, assistant_message)
+        await compact_history(chat_session, GENERATIVE_MODEL, strip=strip_retrieved_context)
         
         return assistant_message
         
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error generating response: {str(e)}")
         traceback.print_exc()
@@ -150,12 +263,49 @@ def generate_chat_response(chat_session: List[Dict], message: Dict) -> str:
             detail=f"Failed to generate response: {str(e)}"
         )
 
+
+async def generate_chat_response_stream(chat_session: List[Dict], message: Dict) -> AsyncIterator[str]:
+    """Generate a response and yield the text as Claude streams it"""
+    first_turn = not chat_session
+    cached_answer, query_embedding = await lookup_semantic_cache(chat_session, message)
+    if cached_answer is not None:
+        yield cached_answer
+        return
+    
+    messages, retrieval = await prepare_chat_request(chat_session, message, query_embedding)
+    
+    parts = []
+    async for text in invoke_model_stream_cached(GENERATIVE_MODEL, build_request_body(messages)):
+        parts.append(text)
+        yield text
+    
+    # Add the exchange to the chat history
+    assistant_message = "".join(parts)
+    chat_session.extend(messages[len(chat_session):])
+    chat_session.append({"role": "assistant", "content": assistant_message})
+    update_semantic_cache(first_turn, message, retrieval, assistant_message)
+    await compact_history(chat_session, GENERATIVE_MODEL, strip=strip_retrieved_context)
+
 def rebuild_chat_session(chat_history: List[Dict]) -> List[Dict]:
-    """Rebuild a chat session with complete context"""
+    """
+    Rebuild a chat session from the stored chat history without calling the model.
+    
+    Past questions are restored without their retrieved chunks; the stored answers
+    already reflect that context.
+    """
     new_session = create_chat_session()
     
     for message in chat_history:
-        if message["role"] == "user":
-            generate_chat_response(new_session, message)
+        if message["role"] == "user" and message.get("content"):
+            if new_session and new_session[-1]["role"] == "user":
+                new_session[-1]["content"] += "\n\n" + message["content"]
+            else:
+                new_session.append({"role": "user", "content": message["content"]})
+        elif message["role"] == "assistant" and new_session and new_session[-1]["role"] == "user":
+            new_session.append({"role": "assistant", "content": message["content"]})
+    
+    # Bedrock expects the history to end on an assistant turn
+    while new_session and new_session[-1]["role"] == "user":
+        new_session.pop()
     
-    return new_session
\ No newline at end of file
+    return new_session
@@ -1,6 +1,5 @@
 import os
-import boto3
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, AsyncIterator
 from fastapi import HTTPException
 import base64
 import io
@@ -8,7 +7,9 @@ from PIL import Image
 from pathlib import Path
 import traceback
 import json
-import botocore
+from api.utils.response_cache import invoke_model_cached, invoke_model_stream_cached
+from api.utils.session_store import create_session_store
+from api.utils.history_utils import compact_history, strip_images, request_messages
 
 
 # Setup
@@ -19,19 +20,6 @@ import botocore
 # GENERATIVE_MODEL = "gemini-1.5-flash-002"
 
 
-# Update environment variables and setup
-AWS_REGION = os.environ.get("AWS_DEFAULT_REGION", "us-east-1").strip()
-AWS_ACCESS_KEY_ID = os.environ.get("AWS_ACCESS_KEY_ID").strip()
-AWS_SECRET_ACCESS_KEY = os.environ.get("AWS_SECRET_ACCESS_KEY").strip()
-
-
-# Setup
-bedrock = boto3.client(
-    service_name='bedrock-runtime',
-    region_name=AWS_REGION,
-    aws_access_key_id=AWS_ACCESS_KEY_ID,
-    aws_secret_access_key=AWS_SECRET_ACCESS_KEY
-)
 MODEL_ID = "anthropic.claude-3-5-sonnet-20240620-v1:0"  # or your preferred Claude model
 
 # Configuration settings for the content generation
@@ -62,94 +50,87 @@ Your goal is to provide accurate, helpful information about cheese for each quer
 # )
 
 # Initialize chat sessions
-chat_sessions: Dict[str, List[Dict]] = {}
+chat_sessions = create_session_store("llm")
 
 def create_chat_session() -> List[Dict]:
     """Create a new chat session"""
     return []  # Start with empty list, we'll add system instruction in the first message
 
 
-def generate_chat_response(chat_session: List[Dict], message: Dict) -> str:
-    try:
-        messages = chat_session.copy()
-        
-        # Prepare the message content
-        content = []
-        
-        # Add text content if present
-        if message.get("content"):
-            content.append({
-                "type": "text",
-                "text": message["content"]
-            })
-            
-        # Process image if present
-        if message.get("image"):
-            try:
-                base64_string = message.get("image")
-                if ',' in base64_string:
-                    _, base64_data = base64_string.split(',', 1)
-                else:
-                    base64_data = base64_string
-                
-                content.append({
-                    "type": "image",
-                    "source": {
-                        "type": "base64",
-                        "media_type": "image/jpeg",
-                        "data": base64_data
-                    }
-                })
-            except ValueError as e:
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"Image processing failed: {str(e)}"
-                )
-        
-        # Add the user message to the chat history
-        messages.append({
-            "role": "user",
-            "content": content
+def prepare_chat_request(chat_session: List[Dict], message: Dict) -> List[Dict]:
+    """Build the message list to send to Bedrock for a new user message"""
+    messages = chat_session.copy()
+    
+    # Prepare the message content
+    content = []
+    
+    # Add text content if present
+    if message.get("content"):
+        content.append({
+            "type": "text",
+            "text": message["content"]
         })
         
+    # Process image if present
+    if message.get("image"):
         try:
-            # Prepare the request body exactly as shown in console
-            body = {
-                "anthropic_version": "bedrock-2023-05-31",
-                "max_tokens": generation_config["max_tokens"],
-                "messages": messages
-            }
-            
-            # Call Bedrock
-            response = bedrock.invoke_model(
-                modelId=MODEL_ID,
-                contentType="application/json",
-                accept="application/json",
-                body=json.dumps(body)
-            )
+            base64_string = message.get("image")
+            if ',' in base64_string:
+                _, base64_data = base64_string.split(',', 1)
+            else:
+                base64_data = base64_string
             
-            # Parse the response
-            response_body = json.loads(response['body'].read())
-            assistant_message = response_body['content'][0]['text']
-            
-            # Add the assistant's response to the chat history
-            messages.append({
-                "role": "assistant",
-                "content": [{"type": "text", "text": assistant_message}]
+            content.append({
+                "type": "image",
+                "source": {
+                    "type": "base64",
+                    "media_type": "image/jpeg",
+                    "data": base64_data
+                }
             })
-            
-            return assistant_message
-            
-        except botocore.exceptions.ClientError as e:
-            error_code = e.response['Error']['Code']
-            error_message = e.response['Error']['Message']
-            print(f"AWS Error: {error_code} - {error_message}")
-            print(f"Request body: {json.dumps(body, indent=2)}")
+        except ValueError as e:
             raise HTTPException(
-                status_code=500,
-                detail=f"AWS Error: {error_code} - {error_message}"
+                status_code=400,
+                detail=f"Image processing failed: {str(e)}"
             )
+    
+    # Add the user message to the chat history
+    messages.append({
+        "role": "user",
+        "content": content
+    })
+    return messages
+
+
+def build_request_body(messages: List[Dict]) -> Dict:
+    """Prepare the request body exactly as shown in console"""
+    return {
+        "anthropic_version": "bedrock-2023-05-31",
+        "max_tokens": generation_config["max_tokens"],
+        "messages": request_messages(messages)
+    }
+
+
+async def generate_chat_response(chat_session: List[Dict], message: Dict) -> str:
+    try:
+        messages = prepare_chat_request(chat_session, message)
+        
+        # Call Bedrock
+        response_body = await invoke_model_cached(MODEL_ID, build_request_body(messages))
+        assistant_message = response_body['content'][0]['text']
+        
+        # Add the exchange to the chat history
+        chat_session.append(messages[-1])
+        chat_session.append({
+            "role": "assistant",
+            "content": [{"type": "text", "text": assistant_message}]
+        })
+        await compact_history(chat_session, MODEL_ID, strip=strip_images)
+        
+        return assistant_message
                 
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error generating response: {str(e)}")
         traceback.print_exc()
@@ -158,12 +139,54 @@ def generate_chat_response(chat_session: List[Dict], message: Dict) -> str:
             detail=f"Failed to generate response: {str(e)}"
         )
 
+
+async def generate_chat_response_stream(chat_session: List[Dict], message: Dict) -> AsyncIterator[str]:
+    """Generate a response and yield the text as Bedrock streams it"""
+    messages = prepare_chat_request(chat_session, message)
+    
+    parts = []
+    async for text in invoke_model_stream_cached(MODEL_ID, build_request_body(messages)):
+        parts.append(text)
+        yield text
+    
+    # Add the exchange to the chat history
+    chat_session.append(messages[-1])
+    chat_session.append({
+        "role": "assistant",
+        "content": [{"type": "text", "text": "".join(parts)}]
+    })
+    await compact_history(chat_session, MODEL_ID, strip=strip_images)
+
 def rebuild_chat_session(chat_history: List[Dict]) -> List[Dict]:
-    """Rebuild a chat session with complete context"""
+    """
+    Rebuild a chat session from the stored chat history without calling the model.
+    
+    Stored images are not re-sent; they are noted in the text so the model keeps
+    the context of the conversation.
+    """
     new_session = create_chat_session()
     
     for message in chat_history:
         if message["role"] == "user":
-            generate_chat_response(new_session, message)
+            content = []
+            if message.get("content"):
+                content.append({"type": "text", "text": message["content"]})
+            if message.get("image_path") or message.get("image"):
+                content.append({"type": "text", "text": "[The user shared an image]"})
+            if not content:
+                continue
+            if new_session and new_session[-1]["role"] == "user":
+                new_session[-1]["content"].extend(content)
+            else:
+                new_session.append({"role": "user", "content": content})
+        elif message["role"] == "assistant" and new_session and new_session[-1]["role"] == "user":
+            new_session.append({
+                "role": "assistant",
+                "content": [{"type": "text", "text": message["content"]}]
+            })
+    
+    # Bedrock expects the history to end on an assistant turn
+    while new_session and new_session[-1]["role"] == "user":
+        new_session.pop()
     
-    return new_session
\ No newline at end of file
+    return new_session
@@ -0,0 +1,246 @@
+import time
+import math
+import threading
+from contextlib import contextmanager
+from typing import Dict, Any, Callable, List, Optional, Sequence, Tuple
+
+# Latency buckets in seconds, from disk reads up to long model generations
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+class MetricsRegistry:
+    """The metrics exposed at /metrics, rendered in the Prometheus text format"""
+
+    def __init__(self):
+        self._metrics: Dict[str, "Metric"] = {}
+
+    def register(self, metric: "Metric") -> None:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {_escape(metric.documentation)}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+
+class Metric:
+    """
+    A metric family with a fixed set of label names.
+
+    Values are updated from the event loop and from worker threads (model calls,
+    CNN batches, chat history I/O), so updates take a lock.
+    """
+
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), registry: MetricsRegistry = registry):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], Any] = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"Metric {self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"{self.name}{_labels(self.labelnames, key)} {_format_value(value)}" for key, value in values]
+
+
+class Counter(Metric):
+    """A value that only goes up"""
+
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    A value that goes up and down.
+
+    With `collect`, values are read when the metrics are rendered instead of being
+    set: it returns the current value for each tuple of label values.
+    """
+
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 collect: Optional[Callable[[], Dict[Tuple[str, ...], float]]] = None, registry: MetricsRegistry = registry):
+        super().__init__(name, documentation, labelnames, registry)
+        self.collect = collect
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def samples(self) -> List[str]:
+        if self.collect is None:
+            return super().samples()
+        try:
+            values = sorted(self.collect().items())
+        except Exception as e:
+            print(f"Error collecting metric {self.name}: {str(e)}")
+            return []
+        return [f"{self.name}{_labels(self.labelnames, key)} {_format_value(value)}" for key, value in values]
+
+
+class Histogram(Metric):
+    """Observations counted into cumulative buckets, with their sum and count"""
+
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS, registry: MetricsRegistry = registry):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # One count per bucket (not cumulative), then the sum
+                counts = self._values[key] = [0] * len(self.buckets) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            counts[-1] += value
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = sorted((key, list(counts)) for key, counts in self._values.items())
+        lines = []
+        for key, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _labels(self.labelnames + ("le",), key + (_format_value(bound),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(counts[-1])}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+# Requests per router family
+http_requests = Counter(
+    "http_requests_total", "HTTP requests handled", ["router", "method", "status"]
+)
+http_request_duration = Histogram(
+    "http_request_duration_seconds", "Time to handle an HTTP request, until the last byte of the response", ["router", "method"]
+)
+http_requests_in_progress = Gauge(
+    "http_requests_in_progress", "HTTP requests being handled", ["router"]
+)
+
+# Calls to outbound dependencies (models, vector DB, disk)
+dependency_duration = Histogram(
+    "dependency_duration_seconds", "Time spent in calls to a dependency, retries included", ["dependency", "operation"]
+)
+dependency_errors = Counter(
+    "dependency_errors_total", "Calls to a dependency that raised", ["dependency", "operation"]
+)
+
+
+@contextmanager
+def track_dependency(dependency: str, operation: str):
+    """
+    Time a call to a dependency and count it as an error if it raises.
+
+    Works as a context manager (also around awaits) and as a function decorator.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        dependency_errors.inc(dependency=dependency, operation=operation)
+        raise
+    finally:
+        dependency_duration.observe(time.perf_counter() - started, dependency=dependency, operation=operation)
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware that counts and times requests per router family.
+
+    Requests are labelled with the prefix of the router that serves them (or
+    "other"), never the full path, so chat and session ids do not multiply the
+    series. Streamed responses are timed until their last chunk is sent.
+    """
+
+    def __init__(self, app, prefixes: Sequence[str]):
+        self.app = app
+        # Longest first, so /llm-rag is not taken for /llm
+        self.prefixes = sorted(prefixes, key=len, reverse=True)
+
+    def _router(self, path: str) -> str:
+        for prefix in self.prefixes:
+            if path == prefix or path.startswith(prefix + "/"):
+                return prefix
+        return "other"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        router = self._router(scope["path"])
+        method = scope["method"]
+        status = 500  # Unless a response is started
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        http_requests_in_progress.inc(router=router)
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            http_requests_in_progress.dec(router=router)
+            http_requests.inc(router=router, method=method, status=status)
+            http_request_duration.observe(time.perf_counter() - started, router=router, method=method)
@@ -0,0 +1,97 @@
+import os
+import copy
+import numpy as np
+from PIL import Image
+from collections import OrderedDict
+from typing import Dict, Any, Optional
+
+# Cache settings
+PHASH_CACHE_ENABLED = os.environ.get("PHASH_CACHE_ENABLED", "1") == "1"
+PHASH_CACHE_MAX_ENTRIES = int(os.environ.get("PHASH_CACHE_MAX_ENTRIES", "4096"))
+PHASH_MAX_DISTANCE = int(os.environ.get("PHASH_MAX_DISTANCE", "4"))  # Max differing bits (of 64) for a match
+
+# Set bits per byte value, for Hamming distances (np.bitwise_count needs numpy 2)
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def dhash(pixels: np.ndarray) -> int:
+    """
+    64-bit difference hash of an image.
+
+    The image is reduced to a 9x8 grayscale thumbnail and each bit records whether
+    a pixel is brighter than its right neighbour, so re-compressed, resized or
+    slightly edited copies of a photo hash to the same or nearby values.
+
+    Args:
+        pixels: The decoded RGB image as a (height, width, 3) uint8 array
+    """
+    thumbnail = Image.fromarray(pixels).convert("L").resize((9, 8), Image.BOX)
+    values = np.asarray(thumbnail, dtype=np.int16)
+    bits = (values[:, 1:] > values[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+class PerceptualCache:
+    """
+    Prediction results keyed by perceptual hash, with Hamming-distance matching.
+
+    Exact hashes are found with a dict lookup; otherwise the nearest cached hash
+    within `max_distance` bits is found with one vectorized XOR/popcount pass over
+    all keys. Least recently used entries are evicted beyond `max_entries`.
+    """
+
+    def __init__(self, max_entries: int = PHASH_CACHE_MAX_ENTRIES, max_distance: int = PHASH_MAX_DISTANCE):
+        self.max_entries = max_entries
+        self.max_distance = max_distance
+        self._entries: "OrderedDict[int, Dict]" = OrderedDict()
+        self._keys: Optional[np.ndarray] = None  # Hashes as uint64, rebuilt after changes
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+
+    def _nearest(self, image_hash: int) -> Optional[int]:
+        if self.max_distance <= 0 or not self._entries:
+            return None
+        if self._keys is None:
+            self._keys = np.fromiter(self._entries.keys(), dtype=np.uint64, count=len(self._entries))
+        distances = _POPCOUNT[(self._keys ^ np.uint64(image_hash)).view(np.uint8)].reshape(-1, 8).sum(axis=1)
+        index = int(np.argmin(distances))
+        if distances[index] > self.max_distance:
+            return None
+        return int(self._keys[index])
+
+    def get(self, image_hash: int) -> Optional[Dict]:
+        """A copy of the cached result for the same or a near-identical image"""
+        result = self._entries.get(image_hash)
+        if result is not None:
+            self.hits += 1
+        else:
+            match = self._nearest(image_hash)
+            if match is None:
+                self.misses += 1
+                return None
+            image_hash = match
+            result = self._entries[match]
+            self.near_hits += 1
+        self._entries.move_to_end(image_hash)
+        # Callers store the result in the chat, so they get their own copy
+        return copy.deepcopy(result)
+
+    def put(self, image_hash: int, result: Dict) -> None:
+        if image_hash not in self._entries:
+            self._keys = None
+        self._entries[image_hash] = copy.deepcopy(result)
+        self._entries.move_to_end(image_hash)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._keys = None
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.near_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "near_hits": self.near_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.hits + self.near_hits) / lookups, 4) if lookups else 0.0,
+        }
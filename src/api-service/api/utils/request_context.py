@@ -0,0 +1,31 @@
+from contextvars import ContextVar
+
+# Per-request settings that the utils layer reads without threading them through every call
+cache_bypass: ContextVar[bool] = ContextVar("cache_bypass", default=False)
+session_id: ContextVar[str] = ContextVar("session_id", default="")
+
+
+class RequestContextMiddleware:
+    """
+    ASGI middleware that copies request headers into context variables.
+
+    - `X-Cache-Bypass: 1` or `Cache-Control: no-cache` skips the response caches
+    - `X-Session-ID` names the session for fair queueing of model calls
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        headers = {key.decode("latin-1").lower(): value.decode("latin-1") for key, value in scope["headers"]}
+        bypass = headers.get("x-cache-bypass", "").lower() in ("1", "true") or "no-cache" in headers.get("cache-control", "").lower()
+        token = cache_bypass.set(bypass)
+        session_token = session_id.set(headers.get("x-session-id", ""))
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            session_id.reset(session_token)
+            cache_bypass.reset(token)
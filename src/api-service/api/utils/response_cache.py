@@ -0,0 +1,209 @@
+import os
+import json
+import asyncio
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, AsyncIterator, Optional
+from fastapi.concurrency import run_in_threadpool
+from api.utils.bedrock_utils import invoke_model, invoke_model_stream
+from api.utils.request_context import cache_bypass
+from api.utils.singleflight import SingleFlight
+
+# Cache settings
+RESPONSE_CACHE_ENABLED = os.environ.get("RESPONSE_CACHE_ENABLED", "1") == "1"
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", "1024"))  # In memory
+RESPONSE_CACHE_MAX_DISK_ENTRIES = int(os.environ.get("RESPONSE_CACHE_MAX_DISK_ENTRIES", "100000"))
+RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", str(24 * 3600)))
+RESPONSE_CACHE_PATH = os.environ.get("RESPONSE_CACHE_PATH", os.path.join("chat-history", "response_cache.db"))
+RESPONSE_CACHE_BUSY_TIMEOUT = float(os.environ.get("RESPONSE_CACHE_BUSY_TIMEOUT", "0.5"))  # Seconds to wait on another worker's lock
+
+
+def request_cache_key(model_id: str, body: Dict) -> str:
+    """Hash of the model and the full request body (system prompt, messages, generation config)"""
+    normalized = json.dumps({"model_id": model_id, "body": body}, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    Exact-match cache of model responses.
+
+    A small in-memory LRU sits in front of a SQLite file that survives restarts
+    and is shared by workers. Entries expire after `ttl` seconds; the disk tier is
+    trimmed to `max_disk_entries`, oldest first.
+
+    Disk reads and writes run in the threadpool, so they never block the event
+    loop. A database locked by another worker for longer than `busy_timeout` is
+    treated as a miss (or a skipped write) rather than waited on.
+    """
+
+    # Trim the disk tier every N writes
+    TRIM_EVERY = 256
+
+    def __init__(self, path: str = RESPONSE_CACHE_PATH, max_entries: int = RESPONSE_CACHE_MAX_ENTRIES,
+                 max_disk_entries: int = RESPONSE_CACHE_MAX_DISK_ENTRIES, ttl: float = RESPONSE_CACHE_TTL,
+                 busy_timeout: float = RESPONSE_CACHE_BUSY_TIMEOUT):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.ttl = ttl
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (response, created)
+        self._local = threading.local()
+        self._writes = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.busy = 0
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._connection().execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT NOT NULL, created REAL NOT NULL)"
+        )
+        self._connection().execute("CREATE INDEX IF NOT EXISTS responses_created ON responses (created)")
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _remember(self, key: str, response: Dict, created: float) -> None:
+        self._memory[key] = (response, created)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _read(self, key: str, now: float) -> Optional[tuple]:
+        """Look up a key in the disk tier (runs in the threadpool)"""
+        return self._connection().execute(
+            "SELECT response, created FROM responses WHERE key = ? AND created >= ?",
+            (key, now - self.ttl)
+        ).fetchone()
+
+    def _write(self, key: str, data: str, created: float, trim: bool) -> None:
+        """Store a response in the disk tier (runs in the threadpool)"""
+        conn = self._connection()
+        conn.execute(
+            "INSERT OR REPLACE INTO responses (key, response, created) VALUES (?, ?, ?)",
+            (key, data, created)
+        )
+        if trim:
+            conn.execute("DELETE FROM responses WHERE created < ?", (created - self.ttl,))
+            conn.execute(
+                "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY created DESC LIMIT -1 OFFSET ?)",
+                (self.max_disk_entries,)
+            )
+
+    async def get(self, key: str) -> Optional[Dict]:
+        now = time.time()
+        entry = self._memory.get(key)
+        if entry is not None and now - entry[1] <= self.ttl:
+            self._memory.move_to_end(key)
+            self.memory_hits += 1
+            return entry[0]
+        try:
+            row = await run_in_threadpool(self._read, key, now)
+        except sqlite3.OperationalError as e:
+            # Locked by another worker: generating the response beats waiting for the lock
+            print(f"Response cache unavailable ({str(e)}), treating as a miss")
+            self.busy += 1
+            row = None
+        if row is None:
+            self._memory.pop(key, None)
+            self.misses += 1
+            return None
+        response = json.loads(row[0])
+        self._remember(key, response, row[1])
+        self.disk_hits += 1
+        return response
+
+    async def set(self, key: str, response: Dict) -> None:
+        created = time.time()
+        self._remember(key, response, created)
+        self._writes += 1
+        try:
+            await run_in_threadpool(
+                self._write, key, json.dumps(response, ensure_ascii=False), created, self._writes % self.TRIM_EVERY == 0
+            )
+        except sqlite3.OperationalError as e:
+            # The entry is still served from memory by this worker
+            print(f"Response cache unavailable ({str(e)}), not persisting the response")
+            self.busy += 1
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_entries": len(self._memory),
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "busy": self.busy,
+            "hit_rate": round((self.memory_hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+        }
+
+
+response_cache = ResponseCache()
+
+# Identical requests that arrive while one is already being generated wait for it
+generation_flights = SingleFlight("generation")
+
+
+def _use_cache() -> bool:
+    return RESPONSE_CACHE_ENABLED and not cache_bypass.get()
+
+
+async def invoke_model_cached(model_id: str, body: Dict) -> Dict:
+    """invoke_model, answered from the response cache (or an identical in-flight call) for identical requests"""
+    if not _use_cache():
+        return await invoke_model(model_id, body)
+    key = request_cache_key(model_id, body)
+    response_body = await response_cache.get(key)
+    if response_body is None:
+        async def generate():
+            response_body = await invoke_model(model_id, body)
+            await response_cache.set(key, response_body)
+            return response_body
+        response_body = await generation_flights.do(key, generate)
+    return response_body
+
+
+async def invoke_model_stream_cached(model_id: str, body: Dict) -> AsyncIterator[str]:
+    """invoke_model_stream, answered from the response cache (or an identical in-flight call) for identical requests"""
+    if not _use_cache():
+        async for text in invoke_model_stream(model_id, body):
+            yield text
+        return
+    key = request_cache_key(model_id, body)
+    response_body = await response_cache.get(key)
+    if response_body is None:
+        leader = generation_flights.join(key)
+        if leader is not None:
+            response_body = await asyncio.shield(leader)
+    if response_body is not None:
+        yield response_body['content'][0]['text']
+        return
+
+    # Lead the call: identical requests arriving meanwhile get the full text once it is done
+    flight = generation_flights.begin(key)
+    parts = []
+    try:
+        async for text in invoke_model_stream(model_id, body):
+            parts.append(text)
+            yield text
+        # Store in the same shape as a complete invoke_model response
+        response_body = {"content": [{"type": "text", "text": "".join(parts)}]}
+        await response_cache.set(key, response_body)
+        flight.set_result(response_body)
+    except Exception as e:
+        flight.set_exception(e)
+        raise
+    finally:
+        if not flight.done():
+            # The client went away mid-stream; waiters make their own call
+            flight.set_result(None)
@@ -0,0 +1,93 @@
+import os
+import time
+import threading
+import numpy as np
+from typing import Dict, Any, List, Optional
+
+# Cache settings
+SEMANTIC_CACHE_ENABLED = os.environ.get("SEMANTIC_CACHE_ENABLED", "1") == "1"
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", "0.95"))  # Minimum cosine similarity
+SEMANTIC_CACHE_CAPACITY = int(os.environ.get("SEMANTIC_CACHE_CAPACITY", "2048"))
+SEMANTIC_CACHE_TTL = float(os.environ.get("SEMANTIC_CACHE_TTL", str(24 * 3600)))
+
+
+class SemanticCache:
+    """
+    Answers for first-turn questions, looked up by embedding similarity.
+
+    Embeddings are stored L2-normalized in a preallocated float32 matrix, so a
+    lookup is a single matrix-vector product over at most `capacity` rows. Expired
+    rows are masked out before the best match is picked. When full, the oldest
+    entry is overwritten.
+    """
+
+    def __init__(self, capacity: int = SEMANTIC_CACHE_CAPACITY, threshold: float = SEMANTIC_CACHE_THRESHOLD, ttl: float = SEMANTIC_CACHE_TTL):
+        self.capacity = capacity
+        self.threshold = threshold
+        self.ttl = ttl
+        self._matrix: Optional[np.ndarray] = None  # Allocated on first add, once the dimension is known
+        self._created = np.zeros(capacity, dtype=np.float64)  # Creation time of each row
+        self._entries: List[Optional[Dict]] = [None] * capacity
+        self._size = 0
+        self._next = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _normalize(embedding: List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, embedding: List[float]) -> Optional[Dict]:
+        """
+        Find a cached answer for a similar question.
+
+        Returns:
+            Optional[Dict]: The entry (answer, query, similarity) or None
+        """
+        with self._lock:
+            if self._size == 0 or self._matrix is None or len(embedding) != self._matrix.shape[1]:
+                self.misses += 1
+                return None
+            similarities = self._matrix[:self._size] @ self._normalize(embedding)
+            similarities[self._created[:self._size] < time.time() - self.ttl] = -np.inf
+            index = int(np.argmax(similarities))
+            if similarities[index] < self.threshold:
+                self.misses += 1
+                return None
+            entry = self._entries[index]
+            self.hits += 1
+            return {**entry, "similarity": float(similarities[index])}
+
+    def add(self, embedding: List[float], query: str, answer: str) -> None:
+        """Store the answer to a first-turn question"""
+        vector = self._normalize(embedding)
+        with self._lock:
+            if self._matrix is None or self._matrix.shape[1] != vector.shape[0]:
+                self._matrix = np.zeros((self.capacity, vector.shape[0]), dtype=np.float32)
+                self._entries = [None] * self.capacity
+                self._size = 0
+                self._next = 0
+            created = time.time()
+            self._matrix[self._next] = vector
+            self._created[self._next] = created
+            self._entries[self._next] = {
+                "query": query,
+                "answer": answer,
+                "created": created,
+            }
+            self._next = (self._next + 1) % self.capacity
+            self._size = min(self._size + 1, self.capacity)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": self._size,
+            "capacity": self.capacity,
+            "threshold": self.threshold,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
@@ -0,0 +1,346 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional, Tuple
+from fastapi.concurrency import run_in_threadpool
+from api.utils.metrics import Gauge
+
+# Store settings
+SESSION_STORE = os.environ.get("SESSION_STORE", "memory")  # "memory" (per process) or "sqlite" (shared by workers)
+SESSION_STORE_PATH = os.environ.get("SESSION_STORE_PATH", os.path.join("chat-history", "sessions.db"))
+SESSION_STORE_BUSY_TIMEOUT = float(os.environ.get("SESSION_STORE_BUSY_TIMEOUT", "0.5"))  # Seconds to wait on another worker's lock
+
+# Cache settings (each chat family gets its own cache with this budget)
+SESSION_CACHE_MAX_BYTES = int(os.environ.get("SESSION_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+SESSION_CACHE_TTL = float(os.environ.get("SESSION_CACHE_TTL", "3600"))  # Seconds since last use
+
+
+def estimate_session_bytes(chat_session: List[Dict]) -> int:
+    """Approximate the memory held by a chat session by its serialized size"""
+    return len(json.dumps(chat_session, ensure_ascii=False))
+
+
+class SessionCache:
+    """
+    In-process LRU cache of chat sessions with a TTL and a memory budget in bytes.
+
+    Sessions are evicted least-recently-used first once the budget is exceeded, or
+    when they have not been used for `ttl` seconds. Evicted sessions are not lost:
+    the routers fall back to rebuilding them from the chat history on disk with
+    `rebuild_chat_session`, which does not call the model.
+
+    Like `SqliteSessionStore`, `get` returns a copy, so changes a turn makes before
+    it fails never reach the cache; callers store the session again after each turn.
+    """
+
+    def __init__(self, name: str, max_bytes: int = SESSION_CACHE_MAX_BYTES, ttl: float = SESSION_CACHE_TTL):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[List[Dict], int, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, chat_id: str, default: Optional[List[Dict]] = None) -> Optional[List[Dict]]:
+        """Get a session and mark it as recently used"""
+        with self._lock:
+            entry = self._entries.get(chat_id)
+            if entry is None:
+                self.misses += 1
+                return default
+            chat_session, size, last_used = entry
+            if time.monotonic() - last_used > self.ttl:
+                self._remove(chat_id)
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._entries[chat_id] = (chat_session, size, time.monotonic())
+            self._entries.move_to_end(chat_id)
+            self.hits += 1
+            # Messages are copied too, since turns may extend the content of the last one
+            return [dict(message) for message in chat_session]
+
+    def __setitem__(self, chat_id: str, chat_session: List[Dict]) -> None:
+        size = estimate_session_bytes(chat_session)
+        with self._lock:
+            if chat_id in self._entries:
+                self._remove(chat_id)
+            if size > self.max_bytes:
+                # A single session over budget would flush everything else
+                self.evictions += 1
+                return
+            self._entries[chat_id] = (chat_session, size, time.monotonic())
+            self.total_bytes += size
+            self._evict()
+
+    async def load(self, chat_id: str) -> Optional[List[Dict]]:
+        """`get` for the async routers"""
+        return self.get(chat_id)
+
+    async def store(self, chat_id: str, chat_session: List[Dict]) -> None:
+        """Store a session from the async routers"""
+        self[chat_id] = chat_session
+
+    def __contains__(self, chat_id: str) -> bool:
+        return self.get(chat_id) is not None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def pop(self, chat_id: str, default: Optional[List[Dict]] = None) -> Optional[List[Dict]]:
+        with self._lock:
+            if chat_id not in self._entries:
+                return default
+            return self._remove(chat_id)
+
+    def _remove(self, chat_id: str) -> List[Dict]:
+        chat_session, size, _ = self._entries.pop(chat_id)
+        self.total_bytes -= size
+        return chat_session
+
+    def _evict(self) -> None:
+        """Drop expired sessions, then least recently used ones until within budget"""
+        now = time.monotonic()
+        while self._entries:
+            chat_id, (_, _, last_used) = next(iter(self._entries.items()))
+            if now - last_used > self.ttl:
+                self._remove(chat_id)
+                self.expirations += 1
+            elif self.total_bytes > self.max_bytes:
+                self._remove(chat_id)
+                self.evictions += 1
+            else:
+                break
+
+    def stats(self) -> Dict[str, Any]:
+        """Cache counters for monitoring"""
+        lookups = self.hits + self.misses
+        return {
+            "name": self.name,
+            "backend": "memory",
+            "sessions": len(self._entries),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+class SqliteSessionStore:
+    """
+    Chat session store backed by a SQLite file shared by every worker and container
+    that mounts it.
+
+    Follows the same interface, TTL and byte budget as `SessionCache`, so a follow-up
+    message can land on any worker and still find its session. Sessions are stored
+    as JSON, which means `get` returns a copy: callers must store the session again
+    after each turn (the routers already do).
+
+    The async routers use `load` and `store`, which run the disk calls in the
+    threadpool. A database locked by another worker for longer than `busy_timeout`
+    is treated as a miss (the routers rebuild the session from the chat history)
+    or a skipped write, rather than waited on.
+    """
+
+    # Check the byte budget every N writes rather than on every write
+    EVICT_EVERY = 32
+
+    def __init__(self, name: str, path: str = SESSION_STORE_PATH, max_bytes: int = SESSION_CACHE_MAX_BYTES,
+                 ttl: float = SESSION_CACHE_TTL, busy_timeout: float = SESSION_STORE_BUSY_TIMEOUT):
+        self.name = name
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._local = threading.local()
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.busy = 0
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                " family TEXT NOT NULL, chat_id TEXT NOT NULL, data TEXT NOT NULL,"
+                " size INTEGER NOT NULL, last_used REAL NOT NULL,"
+                " PRIMARY KEY (family, chat_id))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS sessions_last_used ON sessions (family, last_used)")
+
+    def _connection(self) -> sqlite3.Connection:
+        """One connection per thread; WAL lets readers in other workers proceed during writes"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _read(self, chat_id: str) -> Optional[List[Dict]]:
+        """Get a session from the database and mark it as recently used"""
+        conn = self._connection()
+        row = conn.execute(
+            "SELECT data, last_used FROM sessions WHERE family = ? AND chat_id = ?",
+            (self.name, chat_id)
+        ).fetchone()
+        if row is None:
+            return None
+        data, last_used = row
+        now = time.time()
+        if now - last_used > self.ttl:
+            conn.execute("DELETE FROM sessions WHERE family = ? AND chat_id = ?", (self.name, chat_id))
+            self.expirations += 1
+            return None
+        conn.execute(
+            "UPDATE sessions SET last_used = ? WHERE family = ? AND chat_id = ?",
+            (now, self.name, chat_id)
+        )
+        return json.loads(data)
+
+    def _write(self, chat_id: str, data: str) -> None:
+        """Store a serialized session in the database"""
+        self._connection().execute(
+            "INSERT OR REPLACE INTO sessions (family, chat_id, data, size, last_used) VALUES (?, ?, ?, ?, ?)",
+            (self.name, chat_id, data, len(data), time.time())
+        )
+        self._writes += 1
+        if self._writes % self.EVICT_EVERY == 0:
+            self._evict()
+
+    def get(self, chat_id: str, default: Optional[List[Dict]] = None) -> Optional[List[Dict]]:
+        """Get a session and mark it as recently used"""
+        try:
+            chat_session = self._read(chat_id)
+        except sqlite3.OperationalError as e:
+            # Locked by another worker: rebuilding the session beats waiting for the lock
+            print(f"Session store unavailable ({str(e)}), treating as a miss")
+            self.busy += 1
+            chat_session = None
+        if chat_session is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return chat_session
+
+    def __setitem__(self, chat_id: str, chat_session: List[Dict]) -> None:
+        data = json.dumps(chat_session, ensure_ascii=False)
+        try:
+            if len(data) > self.max_bytes:
+                self.pop(chat_id)
+                self.evictions += 1
+            else:
+                self._write(chat_id, data)
+        except sqlite3.OperationalError as e:
+            # The next turn rebuilds the session from the chat history instead
+            print(f"Session store unavailable ({str(e)}), not storing the session")
+            self.busy += 1
+
+    async def load(self, chat_id: str) -> Optional[List[Dict]]:
+        """`get` in the threadpool, for the async routers"""
+        return await run_in_threadpool(self.get, chat_id)
+
+    async def store(self, chat_id: str, chat_session: List[Dict]) -> None:
+        """Store a session in the threadpool, for the async routers"""
+        await run_in_threadpool(self.__setitem__, chat_id, chat_session)
+
+    def __contains__(self, chat_id: str) -> bool:
+        return self.get(chat_id) is not None
+
+    def __len__(self) -> int:
+        return self._connection().execute(
+            "SELECT COUNT(*) FROM sessions WHERE family = ?", (self.name,)
+        ).fetchone()[0]
+
+    def pop(self, chat_id: str, default: Optional[List[Dict]] = None) -> Optional[List[Dict]]:
+        chat_session = self.get(chat_id)
+        self._connection().execute("DELETE FROM sessions WHERE family = ? AND chat_id = ?", (self.name, chat_id))
+        return chat_session if chat_session is not None else default
+
+    def _evict(self) -> None:
+        """Drop expired sessions, then least recently used ones until within budget"""
+        conn = self._connection()
+        cursor = conn.execute(
+            "DELETE FROM sessions WHERE family = ? AND last_used < ?",
+            (self.name, time.time() - self.ttl)
+        )
+        self.expirations += cursor.rowcount
+        total_bytes = self._total_bytes()
+        if total_bytes <= self.max_bytes:
+            return
+        rows = conn.execute(
+            "SELECT chat_id, size FROM sessions WHERE family = ? ORDER BY last_used",
+            (self.name,)
+        )
+        evict = []
+        for chat_id, size in rows:
+            if total_bytes <= self.max_bytes:
+                break
+            evict.append((self.name, chat_id))
+            total_bytes -= size
+        conn.executemany("DELETE FROM sessions WHERE family = ? AND chat_id = ?", evict)
+        self.evictions += len(evict)
+
+    def _total_bytes(self) -> int:
+        return self._connection().execute(
+            "SELECT COALESCE(SUM(size), 0) FROM sessions WHERE family = ?", (self.name,)
+        ).fetchone()[0]
+
+    def stats(self) -> Dict[str, Any]:
+        """Store counters for monitoring (hits and misses are for this worker only)"""
+        lookups = self.hits + self.misses
+        return {
+            "name": self.name,
+            "backend": "sqlite",
+            "sessions": len(self),
+            "bytes": self._total_bytes(),
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "busy": self.busy,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+# Every session store by chat family, for the metrics
+stores: Dict[str, Any] = {}
+
+
+def create_session_store(name: str):
+    """Create the session store for a chat family according to SESSION_STORE"""
+    if SESSION_STORE == "sqlite":
+        store = SqliteSessionStore(name)
+    elif SESSION_STORE == "memory":
+        store = SessionCache(name)
+    else:
+        raise ValueError(f"Unknown SESSION_STORE: {SESSION_STORE}")
+    stores[name] = store
+    return store
+
+
+def _store_stats(field: str) -> Dict[Tuple[str, ...], float]:
+    return {(name,): store.stats()[field] for name, store in stores.items()}
+
+
+chat_sessions_gauge = Gauge(
+    "chat_sessions", "Chat sessions held per chat family", ["family"], collect=lambda: _store_stats("sessions")
+)
+chat_sessions_bytes_gauge = Gauge(
+    "chat_sessions_bytes", "Estimated size of the held chat sessions per chat family", ["family"], collect=lambda: _store_stats("bytes")
+)
@@ -0,0 +1,84 @@
+import asyncio
+from typing import Dict, Any, Awaitable, Callable, Optional
+
+# Every SingleFlight by name, for /stats
+flights: Dict[str, "SingleFlight"] = {}
+
+
+def _retrieve_exception(future: asyncio.Future) -> None:
+    # Failures are delivered to whoever awaits the call; mark them seen so asyncio
+    # does not log them when nobody was waiting
+    if not future.cancelled():
+        future.exception()
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical calls into one in-flight upstream call.
+
+    The first caller for a key starts the call; callers arriving while it runs
+    await the same result instead of starting their own. The call runs as its own
+    task, so it completes for the others even if the caller that started it goes
+    away. Results are shared between callers and must be treated as read-only.
+
+    Long-running producers (e.g. a streamed response) can register themselves with
+    begin() and resolve the future once they have the full result; resolving it
+    with None means the result was abandoned and waiters should make their own call.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls: Dict[str, asyncio.Future] = {}
+        self.calls = 0
+        self.shared = 0
+        flights[name] = self
+
+    def join(self, key: str) -> Optional[asyncio.Future]:
+        """The in-flight call for a key, if any"""
+        future = self._calls.get(key)
+        if future is not None:
+            self.shared += 1
+        return future
+
+    def _register(self, key: str, future: asyncio.Future) -> None:
+        self._calls[key] = future
+        self.calls += 1
+        future.add_done_callback(_retrieve_exception)
+        future.add_done_callback(lambda f: self._calls.pop(key) if self._calls.get(key) is f else None)
+
+    def begin(self, key: str) -> asyncio.Future:
+        """Register an in-flight call whose result the caller will set on the returned future"""
+        future = asyncio.get_running_loop().create_future()
+        self._register(key, future)
+        return future
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Run `fn()` once for all concurrent callers with the same key.
+
+        Args:
+            key: Identity of the call
+            fn: Starts the upstream call
+
+        Returns:
+            Any: The shared result
+        """
+        future = self.join(key)
+        if future is not None:
+            result = await asyncio.shield(future)
+            if result is not None:
+                return result
+        task = asyncio.ensure_future(fn())
+        self._register(key, task)
+        return await asyncio.shield(task)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": len(self._calls),
+            "calls": self.calls,
+            "shared": self.shared,
+        }
+
+
+def singleflight_stats() -> Dict[str, Dict[str, Any]]:
+    return {name: flight.stats() for name, flight in flights.items()}
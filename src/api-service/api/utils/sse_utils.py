@@ -0,0 +1,58 @@
+import json
+import uuid
+from typing import Dict, Any, AsyncIterator, Callable
+from fastapi import HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+
+
+def format_sse(event: str, data: Any) -> str:
+    """Format a single Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+async def stream_chat_events(chat: Dict, deltas: AsyncIterator[str], save_chat: Callable[[Dict], None]) -> AsyncIterator[str]:
+    """
+    Relay generated text to the client as SSE and persist the chat once generation completes.
+
+    Emits `delta` events with the text as it is generated, then a single `done` event
+    carrying the saved chat (same shape as the non-streaming response). Failures are
+    reported as an `error` event since the HTTP status has already been sent.
+
+    Args:
+        chat: The chat being updated, with the user message already appended
+        deltas: Async iterator of generated text
+        save_chat: Callback that persists the completed chat (blocking; runs in the threadpool)
+    """
+    parts = []
+    try:
+        async for text in deltas:
+            parts.append(text)
+            yield format_sse("delta", {"text": text})
+    except HTTPException as e:
+        yield format_sse("error", {"status_code": e.status_code, "detail": e.detail})
+        return
+    except Exception as e:
+        print(f"Error streaming response: {str(e)}")
+        yield format_sse("error", {"status_code": 500, "detail": f"Failed to generate response: {str(e)}"})
+        return
+
+    chat["messages"].append({
+        "message_id": str(uuid.uuid4()),
+        "role": "assistant",
+        "content": "".join(parts)
+    })
+    await run_in_threadpool(save_chat, chat)
+    yield format_sse("done", chat)
+
+
+def sse_response(events: AsyncIterator[str]) -> StreamingResponse:
+    """Wrap an SSE event iterator in a response that proxies will not buffer"""
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+        }
+    )
@@ -0,0 +1,22 @@
+import os
+import sys
+import shutil
+import tempfile
+
+# The utils read their settings (and create their directories) at import, before any
+# tmp_path exists; point them at a throwaway directory removed after the run
+_tmp = tempfile.mkdtemp(prefix="api-service-tests-")
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "test")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "test")
+os.environ.setdefault("CHROMADB_HOST", "localhost")
+os.environ.setdefault("CHROMADB_PORT", "8000")
+os.environ.setdefault("CHAT_HISTORY_DIR", os.path.join(_tmp, "chat-history"))
+os.environ.setdefault("RESPONSE_CACHE_PATH", os.path.join(_tmp, "response_cache.db"))
+os.environ.setdefault("SESSION_STORE_PATH", os.path.join(_tmp, "sessions.db"))
+os.environ.setdefault("IMAGE_CACHE_DIR", os.path.join(_tmp, "image-cache"))
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(_tmp, ignore_errors=True)
@@ -0,0 +1,52 @@
+import json
+import time
+import asyncio
+import threading
+
+from api.utils import bedrock_utils
+
+
+class FakeEventStream:
+    """A Bedrock response body that produces text deltas until it is closed"""
+
+    def __init__(self):
+        self.closed = threading.Event()
+        self.events_read = 0
+
+    def __iter__(self):
+        while not self.closed.is_set():
+            self.events_read += 1
+            chunk = {"type": "content_block_delta", "delta": {"type": "text_delta", "text": f"part{self.events_read} "}}
+            yield {"chunk": {"bytes": json.dumps(chunk).encode()}}
+            time.sleep(0.01)
+
+    def close(self):
+        self.closed.set()
+
+
+class FakeBedrock:
+    def __init__(self):
+        self.streams = []
+
+    def invoke_model_with_response_stream(self, **kwargs):
+        stream = FakeEventStream()
+        self.streams.append(stream)
+        return {"body": stream}
+
+
+def test_abandoned_stream_stops_producer(monkeypatch):
+    fake = FakeBedrock()
+    monkeypatch.setattr(bedrock_utils, "bedrock", fake)
+
+    async def consume_first_delta():
+        deltas = bedrock_utils.invoke_model_stream("anthropic.claude-test", {"messages": []})
+        first = await deltas.__anext__()
+        await deltas.aclose()  # The client went away
+        return first
+
+    assert asyncio.run(consume_first_delta()) == "part1 "
+    stream = fake.streams[0]
+    assert stream.closed.wait(1)
+    events_read = stream.events_read
+    time.sleep(0.1)
+    assert stream.events_read == events_read
@@ -0,0 +1,69 @@
+import os
+
+from api.utils.chat_utils import ChatIndex
+
+
+def _index(tmp_path):
+    index = ChatIndex(str(tmp_path))
+    for chat_id, dts in [("c0", 100), ("c1", 100), ("c2", 100), ("c3", 200), ("c4", 300), ("c5", 50)]:
+        index.update({"chat_id": chat_id, "title": chat_id, "dts": dts})
+    return index
+
+
+def _pages(index, limit):
+    pages, cursor = [], {}
+    while True:
+        page = index.page(limit, **cursor)
+        if not page:
+            return pages
+        pages.append([summary["chat_id"] for summary in page])
+        cursor = {"before": page[-1]["dts"], "before_id": page[-1]["chat_id"]}
+
+
+def test_pages_split_equal_timestamps(tmp_path):
+    pages = _pages(_index(tmp_path), 3)
+    assert pages == [["c4", "c3", "c0"], ["c1", "c2", "c5"]]
+
+
+def test_every_chat_is_paged_once(tmp_path):
+    index = _index(tmp_path)
+    for limit in range(1, 7):
+        chat_ids = [chat_id for page in _pages(index, limit) for chat_id in page]
+        assert chat_ids == ["c4", "c3", "c0", "c1", "c2", "c5"]
+
+
+def test_before_alone_returns_older_chats(tmp_path):
+    page = _index(tmp_path).page(before=100)
+    assert [summary["chat_id"] for summary in page] == ["c5"]
+
+
+def test_index_compacted_by_another_worker_is_reloaded(tmp_path):
+    writer = _index(tmp_path)
+    writer.update({"chat_id": "c0", "title": "renamed", "dts": 100})
+    reader = ChatIndex(str(tmp_path))
+    reader.page()
+
+    # The compacted index grows past what the reader has already read
+    writer.compact()
+    for chat_id, dts in [("c6", 400), ("c7", 500), ("c8", 600)]:
+        writer.update({"chat_id": chat_id, "title": chat_id, "dts": dts})
+
+    page = reader.page()
+    assert [summary["chat_id"] for summary in page] == ["c8", "c7", "c6", "c4", "c3", "c0", "c1", "c2", "c5"]
+    assert page[5]["title"] == "renamed"
+
+
+def test_compaction_keeps_lines_appended_by_another_worker(tmp_path):
+    index = _index(tmp_path)
+    ChatIndex(str(tmp_path)).update({"chat_id": "c6", "title": "c6", "dts": 400})
+    index.compact()
+
+    assert [summary["chat_id"] for summary in ChatIndex(str(tmp_path)).page()] == ["c6", "c4", "c3", "c0", "c1", "c2", "c5"]
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".tmp")]
+
+
+def test_routers_keep_chat_history_in_the_configured_directory():
+    from api.routers import llm_chat
+
+    assert llm_chat.chat_manager.history_dir == os.path.join(os.environ["CHAT_HISTORY_DIR"], "llm")
+    assert os.path.isdir(llm_chat.chat_manager.images_dir)
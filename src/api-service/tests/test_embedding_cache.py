@@ -0,0 +1,48 @@
+import os
+import time
+import asyncio
+import sqlite3
+
+from api.utils.embedding_cache import EmbeddingCache
+
+
+def test_round_trip_through_disk(tmp_path):
+    async def run():
+        await EmbeddingCache(directory=str(tmp_path)).put("titan", "What is  Brie?", [0.5, 0.25])
+        return await EmbeddingCache(directory=str(tmp_path)).get("titan", "What is Brie?")
+
+    assert asyncio.run(run()).tolist() == [0.5, 0.25]
+
+
+def test_locked_database_does_not_block_the_event_loop(tmp_path):
+    asyncio.run(EmbeddingCache(directory=str(tmp_path)).put("titan", "What is Brie?", [0.5, 0.25]))
+    cache = EmbeddingCache(directory=str(tmp_path), busy_timeout=0.2)
+    other_worker = sqlite3.connect(os.path.join(str(tmp_path), "titan", "index.db"), isolation_level=None)
+    other_worker.execute("BEGIN EXCLUSIVE")
+
+    async def run():
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.01)
+
+        ticker = asyncio.ensure_future(tick())
+        started = time.monotonic()
+        vector = await cache.get("titan", "What is Brie?")
+        await cache.put("titan", "What is Camembert?", [0.125, 0.75])
+        elapsed = time.monotonic() - started
+        ticker.cancel()
+        return elapsed, ticks, vector, await cache.get("titan", "What is Camembert?")
+
+    try:
+        elapsed, ticks, vector, cached = asyncio.run(run())
+    finally:
+        other_worker.execute("ROLLBACK")
+    assert elapsed < 2
+    assert ticks >= 5  # The loop kept running while the disk tier waited on the lock
+    assert vector.tolist() == [0.5, 0.25]  # WAL readers are not blocked by the writer
+    assert cache.busy == 1
+    assert cached.tolist() == [0.125, 0.75]  # Still served from memory
@@ -0,0 +1,57 @@
+import os
+import pytest
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+
+from api.utils.file_utils import parse_range_header, range_file_response, MAX_RANGES
+
+
+@pytest.mark.parametrize("header", ["bytes=--5", "bytes=-", "bytes=-0", "bytes=+1-5", "bytes=1-+5", "bytes= -5x", "bytes=5"])
+def test_malformed_ranges_are_ignored(header):
+    assert parse_range_header(header, 1000) is None
+
+
+def test_suffix_range():
+    assert parse_range_header("bytes=-100", 1000) == [(900, 999)]
+    assert parse_range_header("bytes=-5000", 1000) == [(0, 999)]
+
+
+def test_overlapping_and_adjacent_ranges_are_merged():
+    assert parse_range_header("bytes=0-99,50-149,150-199,300-399", 1000) == [(0, 199), (300, 399)]
+    assert parse_range_header("bytes=500-599,0-99", 1000) == [(0, 99), (500, 599)]
+    assert parse_range_header("bytes=0-,0-,0-", 1000) == [(0, 999)]
+
+
+def test_too_many_ranges_are_ignored():
+    specs = ",".join(f"{i * 10}-{i * 10 + 1}" for i in range(MAX_RANGES + 1))
+    assert parse_range_header(f"bytes={specs}", 1000) is None
+
+
+def test_unsatisfiable_ranges():
+    assert parse_range_header("bytes=2000-3000", 1000) == []
+
+
+@pytest.fixture
+def client(tmp_path):
+    path = tmp_path / "episode.mp3"
+    path.write_bytes(bytes(range(256)) * 4)
+    app = FastAPI()
+
+    @app.get("/file")
+    async def get_file(request: Request):
+        return range_file_response(request, str(path))
+
+    return TestClient(app)
+
+
+def test_negative_suffix_serves_whole_file(client):
+    response = client.get("/file", headers={"Range": "bytes=--5"})
+    assert response.status_code == 200
+    assert response.headers["content-length"] == "1024"
+
+
+def test_repeated_whole_file_ranges_send_it_once(client):
+    response = client.get("/file", headers={"Range": "bytes=" + ",".join(["0-"] * MAX_RANGES)})
+    assert response.status_code == 206
+    assert response.headers["content-range"] == "bytes 0-1023/1024"
+    assert len(response.content) == 1024
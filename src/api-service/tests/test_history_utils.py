@@ -0,0 +1,57 @@
+import asyncio
+
+from api.utils import history_utils
+from api.utils.history_utils import TOKENS_KEY, compact_history, request_messages
+
+
+def _turns(count):
+    session = []
+    for i in range(count):
+        session.append({"role": "user", "content": f"Question {i} " + "x" * 40})
+        session.append({"role": "assistant", "content": f"Answer {i} " + "y" * 40})
+    return session
+
+
+def _count_calls(monkeypatch):
+    calls = []
+    message_tokens = history_utils.message_tokens
+
+    def counting(message):
+        calls.append(message)
+        return message_tokens(message)
+    monkeypatch.setattr(history_utils, "message_tokens", counting)
+    return calls
+
+
+def test_only_new_messages_are_counted(monkeypatch):
+    calls = _count_calls(monkeypatch)
+    session = _turns(10)
+    asyncio.run(compact_history(session, "model", budget=100000))
+    assert len(calls) == 20
+
+    calls.clear()
+    session += _turns(1)
+    asyncio.run(compact_history(session, "model", budget=100000))
+    assert len(calls) == 2
+
+
+def test_request_messages_drop_token_counts():
+    session = _turns(2)
+    asyncio.run(compact_history(session, "model", budget=100000))
+    assert all(TOKENS_KEY in message for message in session)
+    assert all(TOKENS_KEY not in message for message in request_messages(session))
+    assert [m["content"] for m in request_messages(session)] == [m["content"] for m in session]
+
+
+def test_stripped_messages_are_recounted(monkeypatch):
+    monkeypatch.setattr(history_utils, "HISTORY_KEEP_MESSAGES", 2)
+    session = _turns(4)
+    asyncio.run(compact_history(session, "model", budget=100000))
+
+    def strip(message):
+        return {**message, "content": message["content"][:10]}
+
+    budget = sum(message[TOKENS_KEY] for message in session) - 1
+    asyncio.run(compact_history(session, "model", strip=strip, budget=budget))
+    for message in session:
+        assert message[TOKENS_KEY] == history_utils.message_tokens(message)
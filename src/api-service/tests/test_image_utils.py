@@ -0,0 +1,38 @@
+import io
+import math
+import numpy as np
+from PIL import Image
+
+from api.utils.image_utils import resize_bilinear, preprocess_image, image_height, image_width
+
+
+def _tf_resize_bilinear(pixels, height, width):
+    """tf.image.resize(method="bilinear", antialias=False), written out per pixel"""
+    in_height, in_width = pixels.shape[:2]
+    pixels = pixels.astype(np.float64)
+    out = np.zeros((height, width, pixels.shape[2]))
+    for y in range(height):
+        fy = (y + 0.5) * in_height / height - 0.5
+        y0, y1, ly = max(math.floor(fy), 0), min(math.ceil(fy), in_height - 1), fy - math.floor(fy)
+        for x in range(width):
+            fx = (x + 0.5) * in_width / width - 0.5
+            x0, x1, lx = max(math.floor(fx), 0), min(math.ceil(fx), in_width - 1), fx - math.floor(fx)
+            top = pixels[y0, x0] + (pixels[y0, x1] - pixels[y0, x0]) * lx
+            bottom = pixels[y1, x0] + (pixels[y1, x1] - pixels[y1, x0]) * lx
+            out[y, x] = top + (bottom - top) * ly
+    return out
+
+
+def test_resize_matches_training_resize():
+    pixels = np.random.default_rng(0).integers(0, 256, (61, 83, 3), dtype=np.uint8)
+    for height, width in [(24, 24), (40, 100), (120, 90)]:
+        np.testing.assert_allclose(resize_bilinear(pixels, height, width), _tf_resize_bilinear(pixels, height, width), atol=1e-2)
+
+
+def test_preprocess_image_decodes_any_format():
+    for image_format in ("PNG", "JPEG", "WEBP"):
+        data = io.BytesIO()
+        Image.new("RGB", (640, 480), (200, 120, 40)).save(data, image_format)
+        pixels = preprocess_image(data.getvalue())
+        assert pixels.shape == (image_height, image_width, 3)
+        assert pixels.dtype == np.float32
@@ -0,0 +1,71 @@
+import asyncio
+import copy
+import pytest
+from fastapi import HTTPException
+
+from api.utils import llm_rag_utils
+
+
+@pytest.fixture
+def rag(monkeypatch):
+    """llm_rag_utils with retrieval stubbed out and Claude failing"""
+    async def generate_query_embedding(query):
+        return [0.1, 0.2, 0.3]
+
+    async def query_collection(query_embedding, n_results=5):
+        return {"documents": [["Brie is a soft cheese."]], "ids": [["chunk-1"]]}
+
+    async def failing_invoke(model_id, body):
+        raise HTTPException(status_code=429, detail="Too many requests")
+
+    monkeypatch.setattr(llm_rag_utils, "generate_query_embedding", generate_query_embedding)
+    monkeypatch.setattr(llm_rag_utils, "query_collection", query_collection)
+    monkeypatch.setattr(llm_rag_utils, "invoke_model_cached", failing_invoke)
+    monkeypatch.setattr(llm_rag_utils, "SEMANTIC_CACHE_ENABLED", False)
+    return llm_rag_utils
+
+
+def test_failed_turn_leaves_session_unchanged(rag):
+    chat_session = [
+        {"role": "user", "content": "What is Brie?"},
+        {"role": "assistant", "content": "A soft French cheese."},
+    ]
+    before = copy.deepcopy(chat_session)
+
+    with pytest.raises(HTTPException):
+        asyncio.run(rag.generate_chat_response(chat_session, {"content": "How is it made?"}))
+    assert chat_session == before
+
+
+def test_successful_turn_appends_exchange(rag, monkeypatch):
+    async def invoke(model_id, body):
+        assert body["messages"][-1]["role"] == "user"
+        return {"content": [{"type": "text", "text": "From cow's milk."}]}
+
+    async def compact_history(chat_session, model_id, strip=None):
+        pass
+
+    monkeypatch.setattr(rag, "invoke_model_cached", invoke)
+    monkeypatch.setattr(rag, "compact_history", compact_history)
+    chat_session = []
+
+    answer = asyncio.run(rag.generate_chat_response(chat_session, {"content": "How is Brie made?"}))
+    assert answer == "From cow's milk."
+    assert [m["role"] for m in chat_session] == ["user", "assistant"]
+
+
+def test_failed_stream_leaves_session_unchanged(rag, monkeypatch):
+    async def failing_stream(model_id, body):
+        yield "Partial"
+        raise HTTPException(status_code=503, detail="Unavailable")
+
+    monkeypatch.setattr(rag, "invoke_model_stream_cached", failing_stream)
+    chat_session = []
+
+    async def consume():
+        async for _ in rag.generate_chat_response_stream(chat_session, {"content": "How is Brie made?"}):
+            pass
+
+    with pytest.raises(HTTPException):
+        asyncio.run(consume())
+    assert chat_session == []
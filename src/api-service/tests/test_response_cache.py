@@ -0,0 +1,47 @@
+import time
+import asyncio
+import sqlite3
+
+from api.utils.response_cache import ResponseCache
+
+
+def test_round_trip_through_disk(tmp_path):
+    path = str(tmp_path / "responses.db")
+
+    async def run():
+        await ResponseCache(path).set("key", {"content": [{"type": "text", "text": "Brie"}]})
+        return await ResponseCache(path).get("key")
+
+    assert asyncio.run(run()) == {"content": [{"type": "text", "text": "Brie"}]}
+
+
+def test_locked_database_does_not_block_the_event_loop(tmp_path):
+    path = str(tmp_path / "responses.db")
+    cache = ResponseCache(path, busy_timeout=0.2)
+    other_worker = sqlite3.connect(path, isolation_level=None)
+    other_worker.execute("BEGIN EXCLUSIVE")
+
+    async def run():
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.01)
+
+        ticker = asyncio.ensure_future(tick())
+        started = time.monotonic()
+        await cache.set("key", {"content": [{"type": "text", "text": "Brie"}]})
+        elapsed = time.monotonic() - started
+        ticker.cancel()
+        return elapsed, ticks, await cache.get("key")
+
+    try:
+        elapsed, ticks, response = asyncio.run(run())
+    finally:
+        other_worker.execute("ROLLBACK")
+    assert elapsed < 2
+    assert ticks >= 5  # The loop kept running while the write waited on the lock
+    assert cache.busy == 1
+    assert response is not None  # Still served from memory
@@ -0,0 +1,23 @@
+import time
+
+from api.utils.semantic_cache import SemanticCache
+
+
+def test_expired_best_match_does_not_hide_a_live_one():
+    cache = SemanticCache(capacity=4, threshold=0.9, ttl=60)
+    cache.add([1.0, 0.0], "What is Brie?", "A soft cheese.")
+    cache.add([0.98, 0.2], "Tell me about Brie", "A soft French cheese.")
+    cache._created[0] = time.time() - 120  # The exact match has expired
+
+    entry = cache.lookup([1.0, 0.0])
+    assert entry is not None
+    assert entry["answer"] == "A soft French cheese."
+
+
+def test_only_expired_matches_miss():
+    cache = SemanticCache(capacity=4, threshold=0.9, ttl=60)
+    cache.add([1.0, 0.0], "What is Brie?", "A soft cheese.")
+    cache._created[0] = time.time() - 120
+
+    assert cache.lookup([1.0, 0.0]) is None
+    assert cache.misses == 1
@@ -0,0 +1,72 @@
+import time
+import asyncio
+import sqlite3
+
+from api.utils.session_store import SessionCache, SqliteSessionStore
+
+
+def _changes_do_not_leak(store):
+    store["chat"] = [
+        {"role": "user", "content": "What is Brie?"},
+        {"role": "assistant", "content": "A soft French cheese."},
+    ]
+    chat_session = store.get("chat")
+    chat_session.append({"role": "user", "content": "How is it made?"})
+    chat_session[0]["content"] += " And Camembert?"
+
+    assert store.get("chat") == [
+        {"role": "user", "content": "What is Brie?"},
+        {"role": "assistant", "content": "A soft French cheese."},
+    ]
+
+
+def test_memory_get_returns_copy():
+    _changes_do_not_leak(SessionCache("test"))
+
+
+def test_sqlite_get_returns_copy(tmp_path):
+    _changes_do_not_leak(SqliteSessionStore("test", path=str(tmp_path / "sessions.db")))
+
+
+def test_stored_session_replaces_cached_one():
+    store = SessionCache("test")
+    store["chat"] = [{"role": "user", "content": "Hi"}, {"role": "assistant", "content": "Hello"}]
+    chat_session = store.get("chat")
+    chat_session += [{"role": "user", "content": "Brie?"}, {"role": "assistant", "content": "Soft."}]
+    store["chat"] = chat_session
+    assert len(store.get("chat")) == 4
+
+
+def test_locked_database_does_not_block_the_event_loop(tmp_path):
+    path = str(tmp_path / "sessions.db")
+    store = SqliteSessionStore("test", path=path, busy_timeout=0.2)
+    store["chat"] = [{"role": "user", "content": "Hi"}]
+    other_worker = sqlite3.connect(path, isolation_level=None)
+    other_worker.execute("BEGIN EXCLUSIVE")
+
+    async def run():
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.01)
+
+        ticker = asyncio.ensure_future(tick())
+        started = time.monotonic()
+        chat_session = await store.load("chat")
+        await store.store("chat", [{"role": "user", "content": "Brie?"}])
+        elapsed = time.monotonic() - started
+        ticker.cancel()
+        return elapsed, ticks, chat_session
+
+    try:
+        elapsed, ticks, chat_session = asyncio.run(run())
+    finally:
+        other_worker.execute("ROLLBACK")
+    assert elapsed < 2
+    assert ticks >= 5  # The loop kept running while the store waited on the lock
+    assert chat_session is None  # A miss, so the router rebuilds the session
+    assert store.busy == 2
+    assert store.get("chat") == [{"role": "user", "content": "Hi"}]
@@ -0,0 +1,25 @@
+import asyncio
+import threading
+
+from api.utils.sse_utils import stream_chat_events
+
+
+def test_chat_is_saved_off_the_event_loop():
+    saved = []
+
+    def save_chat(chat):
+        saved.append((threading.current_thread(), list(chat["messages"])))
+
+    async def deltas():
+        yield "Soft "
+        yield "cheese."
+
+    async def run():
+        chat = {"chat_id": "chat", "messages": [{"role": "user", "content": "Brie?"}]}
+        return [event async for event in stream_chat_events(chat, deltas(), save_chat)]
+
+    events = asyncio.run(run())
+    assert events[-1].startswith("event: done")
+    thread, messages = saved[0]
+    assert thread is not threading.main_thread()
+    assert messages[-1]["content"] == "Soft cheese."
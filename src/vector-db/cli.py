@@ -1,10 +1,13 @@
 import os
 import argparse
 import pandas as pd
+import numpy as np
 import json
 import time
 import glob
 import hashlib
+import functools
+import unicodedata
 import chromadb
 import requests
 import zipfile
@@ -133,10 +136,18 @@ book_mappings = {
 # 	return embeddings[0].values
 
 
+# Query embeddings are cached as float32 vectors by model and normalized text,
+# so repeated queries skip the Bedrock call and a model change never returns stale vectors
+@functools.lru_cache(maxsize=1024)
+def _cached_query_embedding(model_id, query):
+    embedding = np.asarray(embedding_model.embed_query(query), dtype=np.float32)
+    embedding.flags.writeable = False  # Shared by every caller of the same query
+    return embedding
+
 # Update the generate_query_embedding function
 def generate_query_embedding(query):
-    embedding = embedding_model.embed_query(query)
-    return embedding
+    query = " ".join(unicodedata.normalize("NFC", query).split())
+    return _cached_query_embedding(embedding_model.model_id, query).tolist()
 
 # Update the generate_text_embeddings function
 def generate_text_embeddings(chunks, dimensionality: int = 1536, batch_size=250):